@@ -1,5 +1,17 @@
+import csv
+import gc
 import json
-from typing import Dict
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, TextIO, Tuple
 
 # Flyweight: Lớp lưu intrinsic state (shared_state – phần chung, immutable).
 # GIẢI THÍCH MẪU: Flyweight là "object nhẹ" – chỉ lưu data duplicate cao (như brand/model/color của xe),
@@ -12,56 +24,207 @@ class Flyweight:
     """ The Flyweight stores a common portion of the state (also called intrinsic state) that belongs to multiple real business entities.
     The Flyweight accepts the rest of the state (extrinsic state, unique for each entity) via its method parameters. """
 
-    def __init__(self, shared_state: str) -> None:
+    def __init__(self, shared_state: str, shared_json: Optional[str] = None) -> None:
         # Intrinsic: Chung (e.g., "BMW_M5_red") – share cho xe cùng loại.
         self._shared_state = shared_state
+        # Intrinsic không đổi → serialize đúng 1 lần ở constructor, operation chỉ còn xử lý extrinsic.
+        # shared_json: JSON dựng sẵn (restore snapshot) – bỏ qua json.dumps.
+        self._shared_json = json.dumps(shared_state) if shared_json is None else shared_json
+        self._prefix = f"Flyweight: Displaying shared ({self._shared_json}) and unique ("
+
+    @property
+    def shared_state(self):
+        # Chỉ đọc – không có setter (immutable).
+        return self._shared_state
 
     def operation(self, unique_state: str) -> None:
         # Method dùng extrinsic (unique_state – truyền từ client).
-        s = json.dumps(self._shared_state)  # Đọc intrinsic (nhanh, share).
-        u = json.dumps(unique_state)  # Xử lý extrinsic (riêng mỗi xe).
-        print(
-            f"Flyweight: Displaying shared ({s}) and unique ({u}) state.", end="")
+        u = json.dumps(unique_state)  # Xử lý extrinsic (riêng mỗi xe); intrinsic đã serialize sẵn.
+        print(f"{self._prefix}{u}) state.", end="")
         # ĐIỂM MẤU CHỐT #2: Operation delegate extrinsic qua params – tránh lưu trong flyweight (tiết kiệm RAM).
         # ÁP DỤNG: Trong game, draw() nhận position (extrinsic) để vẽ sprite share (intrinsic).
 
+    def operation_many(self, unique_states: Iterable, out: Optional[TextIO] = None, end: str = "") -> None:
+        """ Renders a batch of extrinsic states into one buffer and writes it with a single call.
+        With the default end="", the output equals calling operation() once per state. """
+        # ÁP DỤNG: Export báo cáo hàng triệu dòng xe – 1 lần write thay vì 1 print/xe.
+        prefix, suffix, dumps = self._prefix, ") state." + end, json.dumps
+        (out or sys.stdout).write("".join([prefix + dumps(u) + suffix for u in unique_states]))
+
 # FlyweightFactory: Factory quản lý pool flyweights (dict _flyweights).
 # GIẢI THÍCH MẪU: Factory tránh tạo duplicate – hash key từ intrinsic, reuse nếu tồn tại.
-# ĐIỂM MẤU CHỐT #3: Key = hash(intrinsic) – đảm bảo unique flyweight cho mỗi combo chung (e.g., "BMW_M5_red").
+# ĐIỂM MẤU CHỐT #3: Key = tuple(intrinsic) giữ thứ tự – ("BMW", "M5", "red") khác ("red", "BMW", "M5"),
+# và "_" trong giá trị không gây đụng key như khi join chuỗi. Không sort, không cấp phát chuỗi mới mỗi lookup.
 # ÁP DỤNG: Trong text editor, factory share font glyphs cho ký tự giống, chỉ tạo mới nếu style khác.
 
 
 class FlyweightFactory:
     """ The Flyweight Factory creates and manages the Flyweight objects. It ensures that flyweights are shared correctly.
     When the client requests a flyweight, the factory either returns an existing instance or creates a new one, if it doesn't exist yet. """
-    _flyweights: Dict[str, Flyweight] = {
-    }  # Pool: Key = hash intrinsic, value = flyweight.
 
-    def __init__(self, initial_flyweights: Dict) -> None:
+    def __init__(self, initial_flyweights: Sequence[Sequence[str]]) -> None:
+        # Pool riêng mỗi factory (Key = tuple intrinsic, value = flyweight) – không share qua class attribute.
+        self._flyweights: Dict[Tuple[str, ...], Flyweight] = {}
+        # Id nhỏ (0, 1, 2...) cho mỗi flyweight – để DB/registry lưu int thay vì reference/chuỗi.
+        self._ids: Dict[Tuple[str, ...], int] = {}
+        self._by_id: List[Flyweight] = []
+        # Counters thay cho print mỗi lookup (đọc qua stats()).
+        self.hits = 0
+        self.misses = 0
         # Init pool với flyweights ban đầu (pre-populate để nhanh).
         for state in initial_flyweights:
-            self._flyweights[self.get_key(state)] = Flyweight(state)
+            key = self.get_key(state)
+            if key not in self._flyweights:
+                self._add(key)
             # ÁP DỤNG: Trong app khởi động, load common types (e.g., 100 font styles) vào pool.
 
-    def get_key(self, state: Dict) -> str:
-        """ Returns a Flyweight's string hash for a given state. """
-        # Tạo key unique từ intrinsic (sorted để ổn định).
-        # E.g., {"BMW", "M5", "red"} → "BMW_M5_red".
-        return "_".join(sorted(state))
-        # ĐIỂM MẤU CHỐT #4: Hash key đơn giản (string join) – O(1) lookup, tránh duplicate.
+    def _add(self, key: Tuple[str, ...]) -> Flyweight:
+        # Key tuple (immutable) dùng luôn làm shared state – không giữ thêm bản copy list.
+        flyweight = self._flyweights[key] = Flyweight(key)
+        self._ids[key] = len(self._by_id)
+        self._by_id.append(flyweight)
+        return flyweight
 
-    def get_flyweight(self, shared_state: Dict) -> Flyweight:
+    def get_key(self, state: Sequence[str]) -> Tuple[str, ...]:
+        """ Returns a Flyweight's key (an order-preserving tuple) for a given state. """
+        # E.g., ["BMW", "M5", "red"] → ("BMW", "M5", "red").
+        # Intern từng chuỗi: triệu record cùng "BMW" chỉ giữ 1 object chuỗi.
+        return tuple(sys.intern(value) if type(value) is str else value for value in state)
+        # ĐIỂM MẤU CHỐT #4: Hash key là tuple – O(k) hash, O(1) lookup, tránh duplicate.
+
+    def get_flyweight(self, shared_state: Sequence[str]) -> Flyweight:
         """ Returns an existing Flyweight with a given state or creates a new one. """
-        key = self.get_key(shared_state)
-        if not self._flyweights.get(key):
-            print("FlyweightFactory: Can't find a flyweight, creating new one.")
-            # Tạo mới nếu chưa có.
-            self._flyweights[key] = Flyweight(shared_state)
-        else:
+        key = tuple(shared_state)  # Đường hit: không intern (dict so sánh theo giá trị).
+        flyweight = self._flyweights.get(key)
+        if flyweight is not None:
             # Reuse – tiết kiệm RAM!
-            print("FlyweightFactory: Reusing existing flyweight.")
-        return self._flyweights[key]
-        # ÁP DỤNG: Trong factory, log để debug (production: remove print cho perf).
+            self.hits += 1
+            return flyweight
+        # Tạo mới nếu chưa có – key lưu trong pool được intern.
+        self.misses += 1
+        return self._add(self.get_key(shared_state))
+        # ÁP DỤNG: Production đọc counters (metrics) thay vì print mỗi lookup.
+
+    def get_flyweight_id(self, shared_state: Sequence[str]) -> int:
+        """ Same as get_flyweight, but returns the Flyweight's small integer id. """
+        key = tuple(shared_state)
+        flyweight_id = self._ids.get(key)
+        if flyweight_id is not None:
+            self.hits += 1
+            return flyweight_id
+        self.misses += 1
+        self._add(self.get_key(shared_state))
+        return len(self._by_id) - 1
+
+    def flyweight_by_id(self, flyweight_id: int) -> Flyweight:
+        """ Returns the Flyweight with the given id. """
+        return self._by_id[flyweight_id]
+
+    # Snapshot: string table (mỗi chuỗi khác nhau lưu 1 lần, nối bằng "\0") + mỗi flyweight = số field
+    # (uint16) và các index vào string table (uint32). Id flyweight giữ nguyên thứ tự.
+    # ĐIỂM MẤU CHỐT #9: Restore không gọi get_key/get_flyweight cho từng entry – decode + split string
+    # table 1 lần, intern mỗi chuỗi 1 lần, dựng JSON từ JSON của từng chuỗi, rồi build dict hàng loạt.
+    SNAPSHOT_MAGIC = b"FWSP"
+    SNAPSHOT_VERSION = 1
+    SNAPSHOT_HEADER = struct.Struct("<4sHIIQ")  # magic, version, số chuỗi, số flyweight, độ dài blob.
+
+    def snapshot(self, path: str) -> None:
+        """ Writes the whole pool (in id order) to a compact string-table file. """
+        strings: Dict[str, int] = {}
+        arities = array("H")
+        indices = array("I")
+        for flyweight in self._by_id:
+            arities.append(len(flyweight.shared_state))
+            for value in flyweight.shared_state:
+                if type(value) is not str or "\0" in value:
+                    raise ValueError(f"Cannot snapshot non-string or NUL-containing state value: {value!r}")
+                index = strings.get(value)
+                if index is None:
+                    index = strings[value] = len(strings)
+                indices.append(index)
+        blob = "\0".join(strings).encode("utf-8")
+        if sys.byteorder != "little":
+            arities.byteswap()
+            indices.byteswap()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION,
+                                              len(strings), len(arities), len(blob)))
+            f.write(blob)
+            f.write(arities)
+            f.write(indices)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def restore(cls, path: str) -> "FlyweightFactory":
+        """ Rebuilds a factory from a snapshot without going through get_key for each entry. """
+        with open(path, "rb") as f:
+            data = f.read()  # 1 lần đọc – restart bị chặn bởi tốc độ disk.
+        header = cls.SNAPSHOT_HEADER
+        if len(data) < header.size:
+            raise ValueError(f"{path} is a truncated flyweight snapshot")
+        magic, version, string_count, flyweight_count, blob_size = header.unpack_from(data)
+        if magic != cls.SNAPSHOT_MAGIC or version != cls.SNAPSHOT_VERSION:
+            raise ValueError(f"{path} is not a flyweight snapshot (version {cls.SNAPSHOT_VERSION})")
+        offset = header.size
+        strings = data[offset:offset + blob_size].decode("utf-8").split("\0") if string_count else []
+        offset += blob_size
+        arities = array("H")
+        arities.frombytes(data[offset:offset + arities.itemsize * flyweight_count])
+        offset += arities.itemsize * flyweight_count
+        indices = array("I")
+        indices.frombytes(data[offset:])
+        if sys.byteorder != "little":
+            arities.byteswap()
+            indices.byteswap()
+        if len(strings) != string_count or len(arities) != flyweight_count or len(indices) != sum(arities):
+            raise ValueError(f"{path} is a truncated flyweight snapshot")
+        if indices and max(indices) >= string_count:
+            raise ValueError(f"{path} is a truncated flyweight snapshot")  # Index trỏ ra ngoài string table.
+
+        strings = list(map(sys.intern, strings))
+        encoded = list(map(json.dumps, strings))  # JSON từng chuỗi – 1 lần/chuỗi khác nhau.
+        if flyweight_count and min(arities) == max(arities):
+            # Fast path (thường gặp): mọi state cùng số field → group bằng zip ở tốc độ C.
+            arity = arities[0]
+            if arity == 0:
+                # zip() không đối số trả rỗng – state rỗng phải được dựng tường minh.
+                keys, jsons = [()] * flyweight_count, [""] * flyweight_count
+            else:
+                keys = list(zip(*[map(strings.__getitem__, indices)] * arity))
+                jsons = list(map(", ".join, zip(*[map(encoded.__getitem__, indices)] * arity)))
+        else:
+            keys, jsons, position = [], [], 0
+            for arity in arities:
+                state_indices = indices[position:position + arity]
+                keys.append(tuple(strings[i] for i in state_indices))
+                jsons.append(", ".join(encoded[i] for i in state_indices))
+                position += arity
+
+        factory = cls([])
+        # Tạo hàng loạt object sống lâu – tắt GC vòng để nó không quét lại heap đang lớn dần nhiều lần.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            factory._by_id = [Flyweight(key, f"[{shared_json}]") for key, shared_json in zip(keys, jsons)]
+            factory._flyweights = dict(zip(keys, factory._by_id))
+            factory._ids = dict(zip(keys, range(flyweight_count)))
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        return factory
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns hit/miss counters, pool size and an estimate of the bytes saved by sharing. """
+        # bytes_saved ≈ số lần reuse x kích thước trung bình 1 flyweight (object + __dict__ + state).
+        pool_size = len(self._flyweights)
+        pool_bytes = sum(
+            sys.getsizeof(flyweight) + sys.getsizeof(flyweight.__dict__)
+            + sys.getsizeof(flyweight._shared_state)
+            for flyweight in self._flyweights.values())
+        average = pool_bytes // pool_size if pool_size else 0
+        return {"hits": self.hits, "misses": self.misses, "pool_size": pool_size,
+                "bytes_saved": self.hits * average}
 
     def list_flyweights(self) -> None:
         # List pool để minh họa share (debug tool).
@@ -70,22 +233,326 @@ class FlyweightFactory:
         print("\n".join(map(str, self._flyweights.keys())), end="")
         # ĐIỂM MẤU CHỐT #5: Pool size nhỏ (e.g., 5 types cho 1M xe) – chứng tỏ share hiệu quả.
 
+# PoliceCarRegistry: "Database" thật – lưu extrinsic (plates, owner) theo cột, mỗi xe chỉ giữ id flyweight.
+# GIẢI THÍCH MẪU: Row i = (plates[i], owners[i], flyweight_ids[i]); intrinsic (brand/model/color) nằm trong pool.
+# ĐIỂM MẤU CHỐT #7: Index – hash index plates -> row; secondary index brand/model/color -> tập flyweight id;
+# mỗi flyweight id -> danh sách row. "Tất cả BMW M5 đỏ" = giao vài tập flyweight id nhỏ rồi lấy row của
+# chúng → chi phí tỉ lệ kích thước kết quả, không quét toàn bộ DB.
+# ÁP DỤNG: Giống bitmap/secondary index trong DB – index trên cột cardinality thấp, share qua flyweight.
+
+
+class CarRecord(NamedTuple):
+    plates: str
+    owner: str
+    brand: str
+    model: str
+    color: str
+
+
+class PoliceCarRegistry:
+    """ Stores cars as columns of extrinsic state referencing flyweight ids, with a hash index on plates and
+    secondary indexes on the flyweight fields. """
+
+    FIELDS = ("brand", "model", "color")  # Vị trí các field trong shared state của flyweight.
+
+    def __init__(self, factory: FlyweightFactory) -> None:
+        self.factory = factory
+        self._plates: List[str] = []
+        self._owners: List[str] = []
+        self._flyweight_ids = array("I")
+        self._by_plate: Dict[str, int] = {}
+        # field value -> flyweight ids (e.g., "red" -> {id BMW_M5_red, id Mercedes_C500_red}).
+        self._by_field: List[Dict[str, Set[int]]] = [{} for _ in self.FIELDS]
+        # flyweight id -> rows của các xe dùng flyweight đó.
+        self._rows_by_flyweight: Dict[int, array] = {}
+
+    def add(self, plates: str, owner: str, flyweight_id: int) -> None:
+        row = self._by_plate.get(plates)
+        if row is None:
+            row = self._by_plate[plates] = len(self._plates)
+            self._plates.append(plates)
+            self._owners.append(owner)
+            self._flyweight_ids.append(flyweight_id)
+        else:
+            # Đăng ký lại (đổi chủ/đổi xe): ghi đè row, giữ index plates.
+            self._owners[row] = owner
+            if self._flyweight_ids[row] == flyweight_id:
+                return
+            # Hiếm – chấp nhận O(bucket) để bỏ row khỏi bucket flyweight cũ.
+            self._rows_by_flyweight[self._flyweight_ids[row]].remove(row)
+            self._flyweight_ids[row] = flyweight_id
+        self._bucket(flyweight_id).append(row)
+
+    def _bucket(self, flyweight_id: int) -> array:
+        rows = self._rows_by_flyweight.get(flyweight_id)
+        if rows is None:
+            rows = self._rows_by_flyweight[flyweight_id] = array("I")
+            # Flyweight mới với registry – index các field của nó (1 lần/flyweight, không phải mỗi xe).
+            state = self.factory.flyweight_by_id(flyweight_id).shared_state
+            for index, value in zip(self._by_field, state):
+                index.setdefault(value, set()).add(flyweight_id)
+        return rows
+
+    def extend(self, plates: List[str], owners: List[str], flyweight_ids: Sequence[int],
+               groups: Optional[Dict[int, Sequence[int]]] = None) -> None:
+        """ Appends a batch of cars. groups optionally maps flyweight id -> offsets in the batch. """
+        start = len(self._plates)
+        batch_index = dict(zip(plates, range(start, start + len(plates))))
+        if len(batch_index) != len(plates) or not self._by_plate.keys().isdisjoint(batch_index):
+            # Có biển số trùng (đăng ký lại) – đi đường từng xe để giữ đúng semantics của add().
+            for car in zip(plates, owners, flyweight_ids):
+                self.add(*car)
+            return
+        # Fast path: mọi thao tác per-row chạy trong C (dict.update, list/array extend, map).
+        self._by_plate.update(batch_index)
+        self._plates.extend(plates)
+        self._owners.extend(owners)
+        self._flyweight_ids.extend(flyweight_ids)
+        if groups is None:
+            groups = {}
+            for offset, flyweight_id in enumerate(flyweight_ids):
+                groups.setdefault(flyweight_id, []).append(offset)
+        for flyweight_id, offsets in groups.items():
+            self._bucket(flyweight_id).extend(map(start.__add__, offsets))
+
+    def _record(self, row: int) -> CarRecord:
+        brand, model, color = self.factory.flyweight_by_id(self._flyweight_ids[row]).shared_state
+        return CarRecord(self._plates[row], self._owners[row], brand, model, color)
+
+    def get(self, plates: str) -> Optional[CarRecord]:
+        row = self._by_plate.get(plates)
+        return None if row is None else self._record(row)
+
+    def find(self, brand: Optional[str] = None, model: Optional[str] = None,
+             color: Optional[str] = None) -> Iterator[CarRecord]:
+        """ Yields the cars matching all the given fields (e.g., find(brand="BMW", model="M5", color="red")). """
+        filters = [(index, value) for index, value in zip(self._by_field, (brand, model, color))
+                   if value is not None]
+        if filters:
+            # Giao từ tập nhỏ nhất – chỉ vài flyweight id.
+            candidate_sets = sorted((index.get(value, set()) for index, value in filters), key=len)
+            flyweight_ids = set(candidate_sets[0]).intersection(*candidate_sets[1:])
+        else:
+            flyweight_ids = set(self._rows_by_flyweight)
+        for flyweight_id in flyweight_ids:
+            for row in self._rows_by_flyweight.get(flyweight_id, ()):
+                yield self._record(row)
+
+    def __len__(self) -> int:
+        return len(self._plates)
+
 # Client function: add_car_to_police_database – Minh họa sử dụng factory + flyweight.
 # GIẢI THÍCH MẪU: Client truyền intrinsic cho factory (get flyweight), extrinsic cho operation.
 # ÁP DỤNG: Trong DB app, add record xe – share type (brand/model/color) cho triệu records.
 
 
 def add_car_to_police_database(
-    factory: FlyweightFactory, plates: str, owner: str, brand: str, model: str, color: str
+    factory: FlyweightFactory, plates: str, owner: str, brand: str, model: str, color: str,
+    registry: Optional[PoliceCarRegistry] = None
 ) -> None:
     print("\n\nClient: Adding a car to database.")
     # Get flyweight từ intrinsic (brand, model, color – chung).
-    flyweight = factory.get_flyweight([brand, model, color])
+    flyweight_id = factory.get_flyweight_id([brand, model, color])
+    flyweight = factory.flyweight_by_id(flyweight_id)
     # Operation với extrinsic (plates, owner – riêng mỗi xe).
     flyweight.operation([plates, owner])
+    if registry is not None:
+        # Lưu thật: chỉ extrinsic + id flyweight.
+        registry.add(plates, owner, flyweight_id)
     # Lợi ích: Xe cùng loại share flyweight – DB chỉ lưu ref + extrinsic (tiết kiệm storage).
 
 
+# Bulk ingestion song song: đọc file CSV (plates,owner,brand,model,color) theo shard, mỗi process worker
+# parse shard với FlyweightFactory local (id local 0..k), parent merge pool local vào pool global (remap id)
+# rồi extend registry theo batch.
+# ĐIỂM MẤU CHỐT #8: Worker chỉ trả về k shared state (k = số loại xe trong shard, nhỏ) + cột extrinsic –
+# parent không phải lookup flyweight cho từng dòng, chỉ remap k id rồi extend ở tốc độ C.
+# ÁP DỤNG: Import export hàng đêm (50M dòng) – tận dụng nhiều core, RAM bị chặn bởi số shard đang xử lý.
+# SỬA LỖI: Shard cắt theo record CSV, không theo dòng vật lý – field quoted có thể chứa newline
+# (e.g., owner "Doe\nJr"), cắt giữa record làm worker nhận nửa record.
+
+
+def _ingest_shard(lines: List[str]) -> Tuple[List[List[str]], List[str], List[str], array,
+                                              Dict[int, array]]:
+    factory = FlyweightFactory([])
+    plates: List[str] = []
+    owners: List[str] = []
+    flyweight_ids = array("I")
+    groups: Dict[int, array] = {}
+    for offset, (plate, owner, brand, model, color) in enumerate(csv.reader(lines)):
+        flyweight_id = factory.get_flyweight_id([brand, model, color])
+        plates.append(plate)
+        owners.append(owner)
+        flyweight_ids.append(flyweight_id)
+        rows = groups.get(flyweight_id)
+        if rows is None:
+            rows = groups[flyweight_id] = array("I")
+        rows.append(offset)
+    states = [flyweight.shared_state for flyweight in factory._by_id]
+    return states, plates, owners, flyweight_ids, groups
+
+
+# Trạng thái parser CSV (dialect excel, như csv.reader) ở từng ký tự.
+_FIELD_START, _IN_FIELD, _QUOTED, _QUOTE_IN_QUOTED = range(4)
+
+
+def _ends_in_quoted_field(line: str, quoted: bool) -> bool:
+    # True nếu sau dòng vật lý này vẫn đang ở giữa quoted field (record chưa kết thúc). Giống csv.reader: dấu "
+    # chỉ mở quoted field ở đầu field (CL1,Bob 5" tall,... là field thường), "" trong quoted field là escape.
+    if not quoted and '"' not in line:
+        return False  # Đường nhanh: dòng không có quote nào.
+    state = _QUOTED if quoted else _FIELD_START
+    for char in line:
+        if state == _QUOTED:
+            if char == '"':
+                state = _QUOTE_IN_QUOTED
+        elif char == '"' and state != _IN_FIELD:
+            state = _QUOTED  # Mở field (_FIELD_START) hoặc "" escape (_QUOTE_IN_QUOTED).
+        elif char == "," or char == "\r" or char == "\n":
+            state = _FIELD_START
+        else:
+            state = _IN_FIELD
+    return state == _QUOTED
+
+
+def _read_records(f: TextIO, max_lines: int) -> List[str]:
+    # islice theo dòng vật lý (nhanh), rồi đọc thêm cho hết record đang mở (newline nằm trong quoted field).
+    lines = list(islice(f, max_lines))
+    quoted = False
+    for line in lines:
+        if quoted or '"' in line:
+            quoted = _ends_in_quoted_field(line, quoted)
+    while quoted:
+        line = next(f, None)
+        if line is None:
+            break  # Quote không đóng tới cuối file – để csv.reader trong worker báo lỗi.
+        lines.append(line)
+        quoted = _ends_in_quoted_field(line, quoted)
+    return lines
+
+
+def _merge_shard(registry: PoliceCarRegistry, shard) -> int:
+    states, plates, owners, local_ids, local_groups = shard
+    # Remap id local -> id global (k lookup/shard, không phải mỗi dòng).
+    remap = [registry.factory.get_flyweight_id(state) for state in states]
+    flyweight_ids = array("I", map(remap.__getitem__, local_ids))
+    groups = {remap[local_id]: offsets for local_id, offsets in local_groups.items()}
+    registry.extend(plates, owners, flyweight_ids, groups)
+    return len(plates)
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource  # Chỉ có trên Unix.
+    except ImportError:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: bytes (macOS), KiB (Linux).
+    peaks = [resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return max(peaks) * scale / 2**20
+
+
+def ingest_police_database(path: str, registry: PoliceCarRegistry, workers: Optional[int] = None,
+                           shard_rows: int = 100_000, header: bool = True) -> Dict[str, Optional[float]]:
+    """ Loads a CSV vehicle export into the registry using a process pool; returns rows/sec and peak RSS. """
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    rows = 0
+    with open(path, newline="", encoding="utf-8") as f, ProcessPoolExecutor(workers) as pool:
+        if header:
+            _read_records(f, 1)
+        in_flight = deque()
+        while True:
+            lines = _read_records(f, shard_rows)
+            if lines:
+                in_flight.append(pool.submit(_ingest_shard, lines))
+            # Giới hạn số shard đang xử lý (RAM bị chặn) và merge theo đúng thứ tự file.
+            while in_flight and (len(in_flight) >= 2 * workers or not lines):
+                rows += _merge_shard(registry, in_flight.popleft().result())
+            if not lines:
+                break
+    elapsed = time.perf_counter() - start
+    return {"rows": rows, "seconds": elapsed, "rows_per_sec": rows / elapsed if elapsed else 0.0,
+            "peak_rss_mb": _peak_rss_mb()}
+
+# Benchmark: Throughput add_car_to_police_database ở hàng triệu lần gọi (stdout -> devnull để đo code,
+# không đo terminal), cộng thêm riêng get_flyweight (đường lookup của factory).
+
+
+def benchmark_police_database(n: int = 1_000_000) -> None:
+    models = [[brand, model, color]
+              for brand, model in (("BMW", "M5"), ("BMW", "X6"), ("Mercedes Benz", "C300"))
+              for color in ("red", "white", "black", "pink")]
+    factory = FlyweightFactory(models)
+
+    start = time.perf_counter()
+    for i in range(n):
+        factory.get_flyweight(models[i % len(models)])
+    lookup_time = time.perf_counter() - start
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        for i in range(n):
+            brand, model, color = models[i % len(models)]
+            add_car_to_police_database(factory, f"CL{i:06d}", "James Doe", brand, model, color)
+        add_time = time.perf_counter() - start
+
+    print(f"get_flyweight: {n / lookup_time:,.0f} lookups/s")
+    print(f"add_car_to_police_database: {n / add_time:,.0f} calls/s")
+    print(f"FlyweightFactory stats: {factory.stats()}")
+
+
+def benchmark_report_export(n: int = 1_000_000) -> None:
+    flyweight = Flyweight(["BMW", "M5", "red"])
+    unique_states = [[f"CL{i:06d}", "James Doe"] for i in range(n)]
+    with open(os.devnull, "w") as devnull:
+        with redirect_stdout(devnull):
+            start = time.perf_counter()
+            for unique_state in unique_states:
+                flyweight.operation(unique_state)
+            one_by_one_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        flyweight.operation_many(unique_states, devnull)
+        batch_time = time.perf_counter() - start
+    print(f"Export {n:,} lines: operation {n / one_by_one_time:,.0f} lines/s, "
+          f"operation_many {n / batch_time:,.0f} lines/s")
+
+
+def benchmark_snapshot(n: int = 500_000) -> None:
+    catalogue = [["Brand%d" % (i % 200), "Model%d" % (i // 200), "color%d" % (i % 16)] for i in range(n)]
+    start = time.perf_counter()
+    factory = FlyweightFactory(catalogue)
+    build_time = time.perf_counter() - start
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "pool.fwsp")
+        factory.snapshot(path)
+        start = time.perf_counter()
+        restored = FlyweightFactory.restore(path)
+        restore_time = time.perf_counter() - start
+        size = os.path.getsize(path)
+    assert len(restored._by_id) == len(factory._by_id)
+    print(f"Pool of {n:,} flyweights ({size / 2**20:.1f} MiB snapshot): "
+          f"FlyweightFactory(catalogue) {build_time * 1e3:.0f} ms, restore {restore_time * 1e3:.0f} ms")
+
+
+def benchmark_ingestion(n: int = 2_000_000, workers: Optional[int] = None) -> None:
+    brands = [("BMW", "M5"), ("BMW", "X6"), ("Mercedes Benz", "C300"), ("Chevrolet", "Camaro2018")]
+    colors = ("red", "white", "black", "pink")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "vehicles.csv")
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["plates", "owner", "brand", "model", "color"])
+            for i in range(n):
+                brand, model = brands[i % len(brands)]
+                writer.writerow([f"CL{i:08d}", f"Owner {i % 1000}", brand, model, colors[i % len(colors)]])
+        registry = PoliceCarRegistry(FlyweightFactory([]))
+        report = ingest_police_database(path, registry, workers)
+    peak_rss = "n/a" if report["peak_rss_mb"] is None else f"{report['peak_rss_mb']:.0f} MiB"
+    print(f"Ingested {report['rows']:,} rows in {report['seconds']:.2f}s "
+          f"({report['rows_per_sec']:,.0f} rows/s, peak RSS {peak_rss})")
+
+
 if __name__ == "__main__":
     """ The client code usually creates a bunch of pre-populated flyweights in the initialization stage of the application. """
     # Init factory với initial flyweights (pre-load common types).
@@ -99,16 +566,34 @@ if __name__ == "__main__":
     # ĐIỂM MẤU CHỐT #6: Pre-populate pool – nhanh cho runtime, đặc biệt app lớn (e.g., load từ DB/cache).
 
     factory.list_flyweights()  # Hiển thị pool ban đầu (5 flyweights).
+    registry = PoliceCarRegistry(factory)
 
     add_car_to_police_database(
-        factory, "CL234IR", "James Doe", "BMW", "M5", "red"
+        factory, "CL234IR", "James Doe", "BMW", "M5", "red", registry
     )  # Reuse "BMW_M5_red".
 
     add_car_to_police_database(
-        factory, "CL234IR", "James Doe", "BMW", "X1", "red"
+        factory, "CL235IR", "James Doe", "BMW", "X1", "red", registry
     )  # Tạo mới "BMW_X1_red" (khác model).
 
+    add_car_to_police_database(
+        factory, "CL777AA", "Jane Roe", "BMW", "M5", "red", registry
+    )
+
     print("\n")
     # Pool tăng lên 6 – minh họa share (BMW_M5_red reuse).
     factory.list_flyweights()
+    print(f"\nFlyweightFactory stats: {factory.stats()}")
+    print(f"Registry lookup CL235IR: {registry.get('CL235IR')}")
+    print(f"All red BMW M5s: {list(registry.find(brand='BMW', model='M5', color='red'))}")
+
+    # Batch: 1 lần write cho cả báo cáo (mỗi xe 1 dòng).
+    factory.get_flyweight(["BMW", "M5", "red"]).operation_many(
+        [[car.plates, car.owner] for car in registry.find(brand="BMW", model="M5", color="red")], end="\n")
+
+    if "--bench" in sys.argv[1:]:
+        benchmark_police_database()
+        benchmark_report_export()
+        benchmark_snapshot()
+        benchmark_ingestion()
     # ÁP DỤNG: Trong production, factory.load_from_db() để populate từ cache/Redis.
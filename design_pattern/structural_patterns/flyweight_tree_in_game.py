@@ -1,15 +1,107 @@
+import csv
+import gc
+import json
+import math
+import mmap
+import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import weakref
+import zlib
+from array import array
+from collections import OrderedDict
+from queue import Queue
+from threading import Lock, Thread
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+# Canvas: RasterCanvas – Target vẽ thật trong memory (1 byte/pixel = index màu palette).
+# ÁP DỤNG: Giống framebuffer của GPU – sprite được "stamp" (copy từng đoạn byte) vào buffer.
+# Toạ độ world (x, y) -> pixel (x - origin_x, y - origin_y); sprite bị clip ở mép canvas.
+# SỬA LỖI: Pixel 0 của sprite là trong suốt (masked blit) – chỉ copy các run pixel khác 0, không ghi đè
+# cây vẽ trước hay background bằng 0.
+_OPAQUE_RUN = re.compile(rb"[^\x00]+")
+
+
+class RasterCanvas:
+    def __init__(self, width, height, origin_x=0, origin_y=0, background=0):
+        self.width = width
+        self.height = height
+        self.origin_x = origin_x  # Góc trên-trái canvas trong toạ độ world (camera).
+        self.origin_y = origin_y
+        self.background = background
+        self.pixels = bytearray([background]) * (width * height)
+
+    def clear(self):
+        self.pixels[:] = bytes([self.background]) * (self.width * self.height)
+
+    def pixel(self, px, py):
+        return self.pixels[py * self.width + px]
+
+    def stamp(self, sprite: Tuple[bytes, ...], x, y):
+        self.stamp_many(sprite, (x,), (y,))
+
+    def stamp_many(self, sprite: Tuple[bytes, ...], xs: Iterable[float], ys: Iterable[float]):
+        # Batch (instanced draw): 1 sprite, nhiều vị trí – mỗi run pixel đặc là 1 slice copy (C-speed),
+        # không format/print gì, không lookup flyweight theo từng cây.
+        pixels, width, height = self.pixels, self.width, self.height
+        size = len(sprite)
+        # Tách run 1 lần/batch: (hàng, cột đầu, bytes của run) – pixel 0 (trong suốt) không bao giờ được ghi.
+        runs = [(r, m.start(), m.group()) for r, row in enumerate(sprite) for m in _OPAQUE_RUN.finditer(row)]
+        ox, oy = self.origin_x, self.origin_y
+        max_px, max_py = width - size, height - size
+        floor = math.floor
+        for x, y in zip(xs, ys):
+            px = floor(x - ox)
+            py = floor(y - oy)
+            if 0 <= px <= max_px and 0 <= py <= max_py:
+                # Fast path: sprite nằm trọn trong canvas.
+                offset = py * width + px
+                for r, c, run in runs:
+                    start = offset + r * width + c
+                    pixels[start:start + len(run)] = run
+            elif px < width and py < height and px + size > 0 and py + size > 0:
+                # Slow path: sprite chạm mép – clip cột/hàng của từng run.
+                c0, c1 = max(0, -px), min(size, width - px)
+                r0, r1 = max(0, -py), min(size, height - py)
+                for r, c, run in runs:
+                    lo, hi = max(c, c0), min(c + len(run), c1)
+                    if r0 <= r < r1 and lo < hi:
+                        start = (py + r) * width + px
+                        pixels[start + lo:start + hi] = run[lo - c:hi - c]
+
 # Flyweight: TreeType – Lưu intrinsic state (chung giữa nhiều tree, immutable).
 # ÁP DỤNG: Intrinsic là data duplicate cao (texture, color) – share để tiết kiệm RAM.
 # ĐIỂM MẤU CHỐT #1: Flyweight nhỏ, reusable; không có setters (immutable sau constructor).
 class TreeType:
+    SPRITE_SIZE = 4  # Sprite vuông SPRITE_SIZE x SPRITE_SIZE pixel.
+
     def __init__(self, name, color, texture):
         self.name = name  # Intrinsic: Chung (e.g., "oak" tree)
         self.color = color  # Intrinsic: Share (e.g., "green")
         self.texture = texture  # Intrinsic: Lớn, duplicate nếu lưu ở mỗi tree
+        # Intrinsic dẫn xuất: sprite raster tính 1 lần từ color/texture, share cho mọi cây cùng type.
+        self.sprite = self._make_sprite()
+
+    def _make_sprite(self) -> Tuple[bytes, ...]:
+        # Màu -> index palette (1..255, 0 là nền); texture -> mask bit (deterministic theo tên).
+        shade = zlib.crc32(str(self.color).encode()) % 255 + 1
+        mask = zlib.crc32(str(self.texture).encode()) | 1  # Luôn có ít nhất 1 pixel.
+        size = self.SPRITE_SIZE
+        return tuple(
+            bytes(shade if mask >> (r * size + c) & 1 else 0 for c in range(size))
+            for r in range(size))
 
     def draw(self, canvas, x, y):
         # Method dùng extrinsic (x, y – truyền từ context).
         # ÁP DỂM: Trong game (Unity), draw tree sprite tại vị trí động, share texture.
+        if isinstance(canvas, RasterCanvas):
+            canvas.stamp(self.sprite, x, y)
+            return
         print(
             f"Draw {self.name} tree (color: {self.color}, texture: {self.texture}) at ({x}, {y})")
 
@@ -19,17 +111,49 @@ class TreeType:
 
 
 class TreeFactory:
-    _tree_types = {}  # Pool: Key = tuple(intrinsic), value = TreeType
+    _tree_types: Dict[Tuple, TreeType] = {}  # Pool: Key = tuple(intrinsic), value = TreeType
+    _lock = Lock()  # Chỉ dùng cho đường ghi (tạo TreeType mới).
+    _hits = 0
+    _misses = 0
 
+    # ĐIỂM MẤU CHỐT #2b: Interning thread-safe – đường đọc không lock (dict/WeakValueDictionary.get),
+    # chỉ khi miss mới lock + check lại (double-checked, giống SingletonMeta) nên không tạo trùng TreeType.
+    # Counters thay cho print: misses chính xác (đếm trong lock), hits best-effort (không lock để đọc nhanh).
     @classmethod
     def get_tree_type(cls, name, color, texture):
         key = (name, color, texture)
-        if key not in cls._tree_types:
-            cls._tree_types[key] = TreeType(name, color, texture)
-            print(f"Created new TreeType: {key}")
-        else:
-            print(f"Reused existing TreeType: {key}")
-        return cls._tree_types[key]
+        tree_type = cls._tree_types.get(key)
+        if tree_type is not None:
+            cls._hits += 1
+            return tree_type
+        with cls._lock:
+            tree_type = cls._tree_types.get(key)
+            if tree_type is None:
+                tree_type = TreeType(name, color, texture)
+                cls._tree_types[key] = tree_type
+                cls._misses += 1
+            else:
+                cls._hits += 1
+        return tree_type
+
+    @classmethod
+    def set_eviction(cls, enabled: bool):
+        # Eviction: pool giữ weak reference – TreeType tự bị xoá khi không còn Tree/Forest nào dùng.
+        with cls._lock:
+            pool_cls = weakref.WeakValueDictionary if enabled else dict
+            cls._tree_types = pool_cls(cls._tree_types)
+
+    @classmethod
+    def stats(cls) -> Dict[str, int]:
+        # Snapshot cho metrics (e.g., export Prometheus) – size giảm dần khi eviction bật.
+        return {"hits": cls._hits, "misses": cls._misses, "size": len(cls._tree_types)}
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._tree_types = type(cls._tree_types)()
+            cls._hits = 0
+            cls._misses = 0
 
 # Context: Tree – Lưu extrinsic state (riêng mỗi tree), reference đến flyweight.
 # ÁP DỤNG: Context nhỏ (chỉ coords + ref), có thể tạo hàng triệu mà không tốn RAM.
@@ -46,12 +170,544 @@ class Tree:
         # Delegate đến flyweight, truyền extrinsic.
         self.tree_type.draw(canvas, self.x, self.y)
 
+# Type table nhị phân: u32 số type, mỗi type = 3 chuỗi UTF-8 (name, color, texture) có prefix độ dài u16.
+# Dùng chung cho các format file của Forest (stream, snapshot) – chỉ lưu intrinsic 1 lần/type.
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+
+
+def _write_type_table(f: BinaryIO, types: List[TreeType]):
+    f.write(_U32.pack(len(types)))
+    for tree_type in types:
+        for field in (tree_type.name, tree_type.color, tree_type.texture):
+            data = str(field).encode("utf-8")
+            f.write(_U16.pack(len(data)))
+            f.write(data)
+
+
+def _read_exact(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated forest file")
+    return data
+
+
+def _read_type_table(f: BinaryIO) -> List[Tuple[str, str, str]]:
+    (count,) = _U32.unpack(_read_exact(f, _U32.size))
+    table = []
+    for _ in range(count):
+        fields = []
+        for _field in range(3):
+            (size,) = _U16.unpack(_read_exact(f, _U16.size))
+            fields.append(_read_exact(f, size).decode("utf-8"))
+        table.append(tuple(fields))
+    return table
+
+
+def _coord(value: float):
+    # Cột float trả float; toạ độ nguyên (plant_tree(1, 2, ...)) được trả lại đúng dạng int như lúc plant.
+    return int(value) if value.is_integer() else value
+
 # Client: Forest – Quản lý contexts, dùng factory tạo flyweights.
 # ÁP DỤNG: Trong simulation (game map), Forest lưu hàng triệu Tree contexts, share 10 TreeTypes.
-# Lợi ích: RAM tiết kiệm – 1M trees chỉ tốn ~1M * sizeof(context) + 10 * sizeof(flyweight).
+# ĐIỂM MẤU CHỐT #4: Layout "struct-of-arrays" (columnar) – thay vì 1 object Tree/cây (mỗi object có __dict__,
+# x/y là float object riêng ~ 200+ bytes/cây), lưu x, y trong typed array (float64) và TreeType dưới dạng
+# index nhỏ (uint16) vào palette TreeType của forest (lấy từ pool TreeFactory) – ~18 bytes/cây.
+# Lợi ích: 5–10M trees chỉ tốn ~90–180MB thay vì vài GB; Tree context chỉ tạo on-demand khi cần.
+# SỬA LỖI: float64 (không phải float32) – float32 làm tròn toạ độ (16777217 -> 16777216, 0.1 -> 0.100000001),
+# float64 giữ đúng mọi giá trị Python float và mọi int tới 2**53. Toạ độ nguyên trả ra lại là int (_coord).
+# ĐIỂM MẤU CHỐT #5: Spatial index (uniform grid) – mỗi cell (cell_size x cell_size) giữ array index các cây
+# trong cell; build lazy ở spatial query đầu tiên, sau đó plant_tree cập nhật luôn (forest chỉ được vẽ
+# toàn bộ/lưu file thì không tốn RAM cho grid). Camera chỉ thấy 1 cửa sổ nhỏ → draw_region/query_radius
+# chỉ duyệt các cell giao với vùng cần, chi phí/frame tỉ lệ số cây thấy được, không phải tổng số cây.
+# ĐIỂM MẤU CHỐT #6: Vẽ lên RasterCanvas theo mô hình instanced draw – gom cây theo TreeType rồi stamp
+# sprite của mỗi type vào tất cả vị trí của nó trong 1 batch (thay vì gọi TreeType.draw từng cây).
+# ĐIỂM MẤU CHỐT #7: Bulk planting – plant_many/load_csv/load_binary resolve mỗi bộ intrinsic khác nhau đúng
+# 1 lần qua TreeFactory (không gọi factory cho từng cây), rồi extend cả cột toạ độ 1 lần.
+# ĐIỂM MẤU CHỐT #8: File snapshot memory-mapped – save() ghi header + type table + các cột fixed-width;
+# open() mmap file và cast thẳng thành cột (không copy, không parse từng cây) → startup gần như tức thì,
+# nhiều worker process mở cùng file share cùng physical pages (page cache). Grid build lazy lần query đầu;
+# ghi thêm cây vào forest đã open sẽ copy cột ra array riêng (copy-on-write).
 
 
 class Forest:
+    COORD_TYPECODE = "d"  # float64 – lưu đúng giá trị đã plant (= Python float), 8 bytes/giá trị.
+    TYPE_ID_TYPECODE = "H"  # uint16 – tối đa 65536 TreeType/forest (thực tế chỉ vài chục).
+    MAX_TYPES = 1 << 16  # Số entry palette mà TYPE_ID_TYPECODE địa chỉ được.
+    INDEX_TYPECODE = "I"  # uint32 – index cây trong cell của grid.
+    STREAM_MAGIC = b"FTS1"  # Format stream nhị phân: magic, type table, rồi các record (x, y, type).
+    STREAM_RECORD = struct.Struct("<ddH")  # float64 x, float64 y, uint16 index type table.
+    FILE_MAGIC = b"FRSM"  # Format snapshot mmap.
+    FILE_VERSION = 2  # v2: cột toạ độ float64 (v1 là float32).
+    FILE_HEADER = struct.Struct("<4sHHQ")  # magic, version, reserved, số cây.
+    FILE_ALIGN = 8  # Các cột bắt đầu ở offset chia hết cho 8.
+
+    def __init__(self, cell_size=64.0):
+        self._xs = array(self.COORD_TYPECODE)  # Cột extrinsic x.
+        self._ys = array(self.COORD_TYPECODE)  # Cột extrinsic y.
+        self._type_ids = array(self.TYPE_ID_TYPECODE)  # Cột index vào palette.
+        # Palette: index nhỏ -> TreeType (flyweight share từ TreeFactory).
+        self._types: List[TreeType] = []
+        self._type_index: Dict[TreeType, int] = {}
+        # Grid: (cell_x, cell_y) -> array index cây (chỉ cell có cây mới tồn tại – sparse).
+        # None = chưa build (lazy, xem _grid()).
+        self.cell_size = float(cell_size)
+        self._cells: Optional[Dict[Tuple[int, int], array]] = None
+        self._mmap: Optional[mmap.mmap] = None  # Có giá trị khi các cột là view vào file (Forest.open).
+
+    def _type_id(self, tree_type: TreeType) -> int:
+        # Map flyweight -> index palette (tạo mới nếu forest chưa dùng type này).
+        type_id = self._type_index.get(tree_type)
+        if type_id is None:
+            type_id = len(self._types)
+            if type_id >= self.MAX_TYPES:
+                # Check trước khi sửa palette – không để lại entry mà không id nào trỏ tới được (save() sẽ lưu nó).
+                raise ValueError(f"Forest supports at most {self.MAX_TYPES} tree types")
+            self._types.append(tree_type)
+            self._type_index[tree_type] = type_id
+        return type_id
+
+    def plant_tree(self, x, y, name, color, texture):
+        # Dùng factory để get flyweight (share), rồi chỉ append vào các cột.
+        tree_type = TreeFactory.get_tree_type(name, color, texture)
+        self._ensure_writable()
+        self._type_ids.append(self._type_id(tree_type))
+        self._xs.append(x)
+        self._ys.append(y)
+        # Index theo giá trị đã lưu trong cột để grid khớp tuyệt đối với cột toạ độ.
+        if self._cells is not None:
+            self._index_tree(len(self._type_ids) - 1)
+
+    def plant_many(self, xs, ys, names, colors, textures):
+        # Bulk: các iterable song song (cùng độ dài) – factory chỉ được gọi cho bộ intrinsic mới.
+        # Check độ dài trước khi resolve: input sai không được thêm TreeType vào palette.
+        xs, ys = array(self.COORD_TYPECODE, xs), array(self.COORD_TYPECODE, ys)
+        names, colors, textures = list(names), list(colors), list(textures)
+        if not len(xs) == len(ys) == len(names) == len(colors) == len(textures):
+            raise ValueError("xs, ys, names, colors and textures must have the same length")
+        self._plant_columns(xs, ys, self._resolve_type_ids(zip(names, colors, textures), {}))
+
+    def _resolve_type_ids(self, keys: Iterable[Tuple], resolved: Dict[Tuple, int]) -> array:
+        # resolved: cache intrinsic tuple -> index palette, giữ qua nhiều chunk khi stream.
+        type_ids = array(self.TYPE_ID_TYPECODE)
+        for key in keys:
+            type_id = resolved.get(key)
+            if type_id is None:
+                type_id = resolved[key] = self._type_id(TreeFactory.get_tree_type(*key))
+            type_ids.append(type_id)
+        return type_ids
+
+    def _plant_columns(self, xs, ys, type_ids: array):
+        new_xs = array(self.COORD_TYPECODE, xs)
+        new_ys = array(self.COORD_TYPECODE, ys)
+        if not len(new_xs) == len(new_ys) == len(type_ids):
+            raise ValueError("xs, ys and tree types must have the same length")
+        self._ensure_writable()
+        start = len(self._type_ids)
+        self._xs.extend(new_xs)
+        self._ys.extend(new_ys)
+        self._type_ids.extend(type_ids)
+        if self._cells is None:
+            return  # Grid chưa build – sẽ build lazy (bao gồm cả cây mới).
+        # Cập nhật grid inline (tránh 1 method call/cây).
+        cells, cell_size, floor = self._cells, self.cell_size, math.floor
+        for i, x, y in zip(range(start, len(self._type_ids)), new_xs, new_ys):
+            key = (floor(x / cell_size), floor(y / cell_size))
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = array(self.INDEX_TYPECODE)
+            cell.append(i)
+
+    def load_csv(self, path, chunk_size=65_536, header=True):
+        # Stream CSV (x,y,name,color,texture) theo chunk – RAM tạm chỉ tỉ lệ chunk_size, không tỉ lệ file.
+        resolved: Dict[Tuple, int] = {}
+        with open(path, newline="", encoding="utf-8") as f:
+            rows = csv.reader(f)
+            if header:
+                next(rows, None)
+            while True:
+                xs, ys, keys = [], [], []
+                for row in rows:
+                    xs.append(float(row[0]))
+                    ys.append(float(row[1]))
+                    keys.append((row[2], row[3], row[4]))
+                    if len(keys) == chunk_size:
+                        break
+                if not keys:
+                    return
+                self._plant_columns(xs, ys, self._resolve_type_ids(keys, resolved))
+
+    def write_binary(self, path):
+        # Ghi stream nhị phân (để load_binary nạp lại hoặc stream qua mạng/pipe).
+        record = self.STREAM_RECORD
+        with open(path, "wb") as f:
+            f.write(self.STREAM_MAGIC)
+            _write_type_table(f, self._types)
+            for x, y, type_id in zip(self._xs, self._ys, self._type_ids):
+                f.write(record.pack(x, y, type_id))
+
+    def load_binary(self, path, chunk_size=65_536):
+        # Đọc stream nhị phân theo chunk record; type table map sang palette của forest 1 lần.
+        record = self.STREAM_RECORD
+        with open(path, "rb") as f:
+            if f.read(len(self.STREAM_MAGIC)) != self.STREAM_MAGIC:
+                raise ValueError(f"{path} is not a forest stream file")
+            lut = self._resolve_type_ids(_read_type_table(f), {})
+            while True:
+                data = f.read(record.size * chunk_size)
+                if not data:
+                    return
+                if len(data) % record.size:
+                    raise ValueError("Truncated forest stream record")
+                xs, ys, file_ids = zip(*record.iter_unpack(data))
+                self._plant_columns(xs, ys, array(self.TYPE_ID_TYPECODE,
+                                                  [lut[type_id] for type_id in file_ids]))
+
+    def save(self, path):
+        # Layout: header | type table | pad | x[n] float64 | pad | y[n] float64 | pad | type[n] uint16.
+        # Ghi ra file tạm rồi os.replace – worker đang mmap file cũ không bị ảnh hưởng.
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.FILE_HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION, 0, len(self)))
+            _write_type_table(f, self._types)
+            for column in (self._xs, self._ys, self._type_ids):
+                f.write(b"\0" * (-f.tell() % self.FILE_ALIGN))
+                if sys.byteorder != "little":
+                    column = array(column.typecode, column)
+                    column.byteswap()
+                f.write(column)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path, cell_size=64.0) -> "Forest":
+        # Mmap read-only: cột là memoryview vào page cache, chỉ type table được parse.
+        forest = cls(cell_size)
+        with open(path, "rb") as f:
+            magic, version, _reserved, count = cls.FILE_HEADER.unpack(_read_exact(f, cls.FILE_HEADER.size))
+            if magic != cls.FILE_MAGIC or version != cls.FILE_VERSION:
+                raise ValueError(f"{path} is not a forest file (version {cls.FILE_VERSION})")
+            forest._resolve_type_ids(_read_type_table(f), {})
+            offset = f.tell()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if count else None
+        # Tính layout + check độ dài file cho cả 3 cột TRƯỚC khi tạo memoryview nào – view đã export thì
+        # mapped.close() ném BufferError (và mmap bị leak) thay vì ValueError.
+        layout = []
+        for typecode in (cls.COORD_TYPECODE, cls.COORD_TYPECODE, cls.TYPE_ID_TYPECODE):
+            offset += -offset % cls.FILE_ALIGN
+            size = array(typecode).itemsize * count
+            layout.append((typecode, offset, size))
+            offset += size
+        if mapped is not None and offset > len(mapped):
+            mapped.close()
+            raise ValueError("Truncated forest file")
+        columns = []
+        for typecode, offset, size in layout:
+            if mapped is None:
+                columns.append(array(typecode))
+            elif sys.byteorder != "little":
+                column = array(typecode, mapped[offset:offset + size])
+                column.byteswap()
+                columns.append(column)
+            else:
+                columns.append(memoryview(mapped)[offset:offset + size].cast(typecode))
+        forest._xs, forest._ys, forest._type_ids = columns
+        forest._mmap = mapped
+        return forest
+
+    def close(self):
+        # Giải phóng mmap của Forest.open – các cột view vào file bị bỏ, forest trở thành rỗng.
+        if self._mmap is None:
+            return
+        for column in (self._xs, self._ys, self._type_ids):
+            if isinstance(column, memoryview):
+                column.release()
+        self._xs, self._ys = array(self.COORD_TYPECODE), array(self.COORD_TYPECODE)
+        self._type_ids = array(self.TYPE_ID_TYPECODE)
+        self._cells = None
+        self._mmap.close()
+        self._mmap = None
+
+    def _ensure_writable(self):
+        # Copy-on-write: cột mmap read-only -> array trong RAM riêng của process trước khi ghi thêm.
+        if self._mmap is None:
+            return
+        columns = []
+        for column in (self._xs, self._ys, self._type_ids):
+            if isinstance(column, memoryview):
+                copy = array(column.format)
+                with column.cast("B") as raw:
+                    copy.frombytes(raw)
+                column.release()
+                column = copy
+            columns.append(column)
+        self._xs, self._ys, self._type_ids = columns
+        self._mmap.close()
+        self._mmap = None
+
+    def warm(self):
+        # Trả trước mọi chi phí "lần đầu" (gọi từ background thread): page-fault các trang mmap (1 byte/trang)
+        # và build grid – frame đầu tiên vẽ forest không phải chờ đĩa hay chạy O(n) trên thread vẽ.
+        if self._mmap is not None:
+            self._mmap[::mmap.PAGESIZE]
+        self._grid()
+
+    def grid_bytes(self) -> int:
+        # Ước lượng RAM của grid (dict + key tuple + array index từng cell); 0 nếu chưa build.
+        if self._cells is None:
+            return 0
+        return sys.getsizeof(self._cells) + sum(sys.getsizeof(key) + sys.getsizeof(cell)
+                                                for key, cell in self._cells.items())
+
+    def _grid(self) -> Dict[Tuple[int, int], array]:
+        if self._cells is None:
+            self._cells = {}
+            for i in range(len(self._type_ids)):
+                self._index_tree(i)
+        return self._cells
+
+    def _cell_of(self, x, y) -> Tuple[int, int]:
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def _index_tree(self, i):
+        key = self._cell_of(self._xs[i], self._ys[i])
+        cell = self._cells.get(key)
+        if cell is None:
+            cell = self._cells[key] = array(self.INDEX_TYPECODE)
+        cell.append(i)
+
+    def _indices_in_rect(self, x0, y0, x1, y1) -> Iterator[int]:
+        # Duyệt các cell giao với hình chữ nhật [x0, x1] x [y0, y1], lọc chính xác từng cây.
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        cx0, cy0 = self._cell_of(x0, y0)
+        cx1, cy1 = self._cell_of(x1, y1)
+        xs, ys, grid = self._xs, self._ys, self._grid()
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) <= len(grid):
+            cells = (grid.get((cx, cy)) for cx in range(cx0, cx1 + 1)
+                     for cy in range(cy0, cy1 + 1))
+        else:
+            # Vùng lớn hơn số cell đang có (e.g., zoom out) – duyệt cell tồn tại thay vì toàn bộ lưới.
+            cells = (cell for (cx, cy), cell in grid.items()
+                     if cx0 <= cx <= cx1 and cy0 <= cy <= cy1)
+        for cell in cells:
+            if cell is None:
+                continue
+            for i in cell:
+                if x0 <= xs[i] <= x1 and y0 <= ys[i] <= y1:
+                    yield i
+
+    def draw_region(self, canvas, x0, y0, x1, y1):
+        # Chỉ vẽ cây trong viewport [x0, x1] x [y0, y1] (camera) – dùng grid, không duyệt toàn forest.
+        if isinstance(canvas, RasterCanvas):
+            self.render(canvas, (x0, y0, x1, y1))
+            return
+        print(f"Drawing forest region ({x0}, {y0}) - ({x1}, {y1}):")
+        types, xs, ys, type_ids = self._types, self._xs, self._ys, self._type_ids
+        for i in self._indices_in_rect(x0, y0, x1, y1):
+            types[type_ids[i]].draw(canvas, _coord(xs[i]), _coord(ys[i]))
+
+    def render(self, canvas: RasterCanvas, region: Optional[Tuple[float, float, float, float]] = None):
+        # Instanced draw: 1 pass gom toạ độ theo type_id, rồi mỗi TreeType stamp 1 batch.
+        xs, ys, type_ids = self._xs, self._ys, self._type_ids
+        indices = range(len(type_ids)) if region is None else self._indices_in_rect(*region)
+        batches: Dict[int, Tuple[array, array]] = {}
+        for i in indices:
+            batch = batches.get(type_ids[i])
+            if batch is None:
+                batch = batches[type_ids[i]] = (array(self.COORD_TYPECODE), array(self.COORD_TYPECODE))
+            batch[0].append(xs[i])
+            batch[1].append(ys[i])
+        for type_id, (batch_xs, batch_ys) in batches.items():
+            canvas.stamp_many(self._types[type_id].sprite, batch_xs, batch_ys)
+
+    def query_radius(self, x, y, r) -> List[Tree]:
+        # Trả về Tree contexts (tạo on-demand) trong bán kính r quanh (x, y), e.g., va chạm/AI tầm nhìn.
+        types, xs, ys, type_ids = self._types, self._xs, self._ys, self._type_ids
+        r2 = r * r
+        found = []
+        for i in self._indices_in_rect(x - r, y - r, x + r, y + r):
+            dx, dy = xs[i] - x, ys[i] - y
+            if dx * dx + dy * dy <= r2:
+                found.append(Tree(_coord(xs[i]), _coord(ys[i]), types[type_ids[i]]))
+        return found
+
+    def draw(self, canvas):
+        if isinstance(canvas, RasterCanvas):
+            self.render(canvas)
+            return
+        print("Drawing forest:")
+        types = self._types
+        for x, y, type_id in zip(self._xs, self._ys, self._type_ids):
+            types[type_id].draw(canvas, _coord(x), _coord(y))  # Delegate đến flyweight, truyền extrinsic.
+
+    def __len__(self):
+        return len(self._type_ids)
+
+    def __iter__(self) -> Iterator[Tree]:
+        # Tạo Tree context on-demand (không lưu) – giữ API hướng đối tượng cho client cũ.
+        types = self._types
+        for x, y, type_id in zip(self._xs, self._ys, self._type_ids):
+            yield Tree(_coord(x), _coord(y), types[type_id])
+
+    @property
+    def trees(self) -> List[Tree]:
+        # Tương thích ngược với Forest.trees cũ – materialize toàn bộ, chỉ nên dùng cho forest nhỏ/debug.
+        return list(self)
+
+# ChunkedForest: World lớn chia thành các chunk (chunk_size x chunk_size), mỗi chunk là 1 Forest snapshot
+# (file Forest.save) – chỉ chunk gần camera được nạp vào RAM.
+# ÁP DỤNG: Open-world game (Minecraft, Skyrim) stream terrain/foliage theo vị trí người chơi.
+# ĐIỂM MẤU CHỐT #9: Chunk dùng chung TreeType qua TreeFactory (Forest.open resolve type table qua factory),
+# nên N chunk "oak" vẫn chỉ có 1 flyweight. Nạp chunk chạy trên background thread (draw không bao giờ chờ I/O
+# – chunk chưa nạp xong thì frame đó chưa vẽ); chunk ngoài tầm camera bị evict theo LRU khi vượt memory_budget.
+# SỬA LỖI: Chỉ mmap thì chưa đọc gì – frame đầu vẫn page-fault cột từ đĩa và build grid O(n) trên thread vẽ.
+# Loader gọi Forest.warm() (chạm mọi trang + build grid) TRƯỚC khi đưa chunk vào _resident, và tính cả RAM
+# của grid vào memory_budget (không chỉ kích thước file).
+
+
+class ChunkedForest:
+    MANIFEST = "manifest.json"
+
+    def __init__(self, directory, memory_budget=64 * 2**20, load_radius=1):
+        with open(os.path.join(directory, self.MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.directory = directory
+        self.chunk_size = float(manifest["chunk_size"])
+        self.memory_budget = memory_budget  # Bytes: kích thước file chunk đã mmap + grid của chunk.
+        self.load_radius = load_radius  # Số chunk quanh chunk chứa camera cần giữ resident.
+        self._available: Set[Tuple[int, int]] = {tuple(key) for key in manifest["chunks"]}
+        self._lock = Lock()  # Bảo vệ các field bên dưới (shared giữa game thread và loader thread).
+        self._resident: "OrderedDict[Tuple[int, int], Forest]" = OrderedDict()  # LRU: cũ nhất ở đầu.
+        self._sizes: Dict[Tuple[int, int], int] = {}
+        self._resident_bytes = 0
+        self._wanted: Set[Tuple[int, int]] = set()  # Chunk quanh camera – không bao giờ bị evict.
+        self._pending: Set[Tuple[int, int]] = set()
+        self.failed: Dict[Tuple[int, int], Exception] = {}
+        self.loads = 0
+        self.evictions = 0
+        self._queue: "Queue[Optional[Tuple[int, int]]]" = Queue()
+        self._loader = Thread(target=self._load_loop, name="forest-chunk-loader", daemon=True)
+        self._loader.start()
+
+    @classmethod
+    def build(cls, directory, forest: Forest, chunk_size=1024.0):
+        # Chia 1 Forest thành file chunk + manifest (bước offline, e.g., lúc export map).
+        groups: Dict[Tuple[int, int], Tuple[array, array, List[TreeType]]] = {}
+        for x, y, type_id in zip(forest._xs, forest._ys, forest._type_ids):
+            key = (math.floor(x / chunk_size), math.floor(y / chunk_size))
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (array(Forest.COORD_TYPECODE), array(Forest.COORD_TYPECODE), [])
+            group[0].append(x)
+            group[1].append(y)
+            group[2].append(forest._types[type_id])
+        os.makedirs(directory, exist_ok=True)
+        for key, (xs, ys, tree_types) in groups.items():
+            chunk = Forest()
+            chunk._plant_columns(xs, ys, array(Forest.TYPE_ID_TYPECODE, map(chunk._type_id, tree_types)))
+            chunk.save(cls._chunk_path(directory, key))
+        with open(os.path.join(directory, cls.MANIFEST), "w", encoding="utf-8") as f:
+            json.dump({"chunk_size": chunk_size, "chunks": sorted(groups)}, f)
+
+    @staticmethod
+    def _chunk_path(directory, key: Tuple[int, int]) -> str:
+        return os.path.join(directory, f"chunk_{key[0]}_{key[1]}.frsm")
+
+    def update_camera(self, x, y):
+        # Gọi mỗi frame từ game loop: xếp hàng nạp chunk còn thiếu (gần trước), chạm LRU, evict nếu vượt budget.
+        ccx, ccy = math.floor(x / self.chunk_size), math.floor(y / self.chunk_size)
+        r = self.load_radius
+        wanted = sorted(((cx, cy) for cx in range(ccx - r, ccx + r + 1) for cy in range(ccy - r, ccy + r + 1)
+                         if (cx, cy) in self._available),
+                        key=lambda key: abs(key[0] - ccx) + abs(key[1] - ccy))
+        with self._lock:
+            self._wanted = set(wanted)
+            for key in wanted:
+                if key in self._resident:
+                    self._resident.move_to_end(key)
+                elif key not in self._pending and key not in self.failed:
+                    self._pending.add(key)
+                    self._queue.put(key)
+            self._evict_locked()
+
+    def _load_loop(self):
+        while True:
+            key = self._queue.get()
+            try:
+                if key is None:
+                    return
+                with self._lock:
+                    if key not in self._wanted:  # Camera đã đi xa trước khi tới lượt – bỏ qua.
+                        self._pending.discard(key)
+                        continue
+                path = self._chunk_path(self.directory, key)
+                try:
+                    forest = Forest.open(path)  # I/O ngoài lock.
+                    forest.warm()  # Page-fault + grid ngay trên loader thread, không để cho thread vẽ.
+                    size = os.path.getsize(path) + forest.grid_bytes()
+                except Exception as exc:
+                    # Bất kỳ lỗi nào của 1 chunk (file hỏng, BufferError...) chỉ đánh dấu chunk đó failed –
+                    # loader thread không được chết, các chunk khác vẫn phải stream tiếp.
+                    with self._lock:
+                        self._pending.discard(key)
+                        self.failed[key] = exc
+                    continue
+                with self._lock:
+                    self._pending.discard(key)
+                    self._resident[key] = forest
+                    self._sizes[key] = size
+                    self._resident_bytes += size
+                    self.loads += 1
+                    self._evict_locked()
+            finally:
+                self._queue.task_done()
+
+    def _evict_locked(self):
+        # LRU: evict chunk ít dùng nhất ngoài tầm camera. Chỉ bỏ reference (không close mmap) – frame đang
+        # vẽ dở vẫn an toàn, mmap được giải phóng khi reference cuối cùng biến mất.
+        for key in list(self._resident):
+            if self._resident_bytes <= self.memory_budget:
+                return
+            if key in self._wanted:
+                continue
+            del self._resident[key]
+            self._resident_bytes -= self._sizes.pop(key)
+            self.evictions += 1
+
+    def _visible_chunks(self) -> List[Forest]:
+        with self._lock:
+            return [self._resident[key] for key in self._wanted if key in self._resident]
+
+    def draw(self, canvas):
+        # Không chờ I/O: chỉ vẽ chunk quanh camera đã resident.
+        for chunk in self._visible_chunks():
+            chunk.draw(canvas)
+
+    def draw_region(self, canvas, x0, y0, x1, y1):
+        for chunk in self._visible_chunks():
+            chunk.draw_region(canvas, x0, y0, x1, y1)
+
+    def wait_until_loaded(self):
+        # Chờ hàng đợi nạp rỗng (loading screen/test) – game loop bình thường không gọi.
+        self._queue.join()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"resident_chunks": len(self._resident), "resident_bytes": self._resident_bytes,
+                    "pending": len(self._pending), "loads": self.loads, "evictions": self.evictions}
+
+    def close(self):
+        self._queue.put(None)
+        self._loader.join()
+        with self._lock:
+            self._resident.clear()
+            self._sizes.clear()
+            self._resident_bytes = 0
+
+# ObjectListForest: Layout cũ (list Tree objects) – giữ lại để so sánh memory với Forest columnar.
+
+
+class ObjectListForest:
     def __init__(self):
         self.trees = []  # List contexts (có thể hàng triệu)
 
@@ -66,6 +722,142 @@ class Forest:
         for tree in self.trees:
             tree.draw(canvas)  # Delegate recursion – dùng extrinsic.
 
+# Benchmark: So sánh memory giữa list-of-objects và columnar (tracemalloc đo allocation thực).
+# ÁP DỤNG: Chạy `python flyweight_tree_in_game.py --bench` trước khi chọn layout cho map lớn.
+
+
+def benchmark_memory(n=200_000, world_size=10_000.0, seed=42):
+    tree_kinds = [("oak", "green", "rough"), ("pine", "dark_green", "smooth"),
+                  ("birch", "white", "thin")]
+    for kind in tree_kinds:  # Warm pool trước để 2 layout đo cùng điều kiện.
+        TreeFactory.get_tree_type(*kind)
+
+    results = {}
+    for forest_cls in (ObjectListForest, Forest):
+        rng = random.Random(seed)
+        gc.collect()
+        tracemalloc.start()
+        forest = forest_cls()
+        for i in range(n):
+            forest.plant_tree(rng.uniform(0, world_size), rng.uniform(0, world_size),
+                              *tree_kinds[i % len(tree_kinds)])
+        current, _peak = tracemalloc.get_traced_memory()
+        results[forest_cls.__name__] = current
+        print(f"{forest_cls.__name__}: {current / 2**20:.1f} MiB for {n} trees "
+              f"({current / n:.1f} bytes/tree)")
+        if isinstance(forest, Forest):
+            forest._grid()  # Grid là index tuỳ chọn (lazy) – báo riêng.
+            grid_bytes = tracemalloc.get_traced_memory()[0] - current
+            print(f"  + spatial grid (cell_size={forest.cell_size:g}): {grid_bytes / n:.1f} bytes/tree")
+        tracemalloc.stop()
+        del forest
+    ratio = results["ObjectListForest"] / results["Forest"]
+    print(f"Columnar Forest uses {ratio:.1f}x less memory")
+    return results
+
+# Benchmark: Nạp map – plant_tree từng cây (factory lookup mỗi cây) so với plant_many bulk.
+
+
+def benchmark_planting(n=200_000, world_size=10_000.0, seed=42):
+    rng = random.Random(seed)
+    tree_kinds = [("oak", "green", "rough"), ("pine", "dark_green", "smooth"),
+                  ("birch", "white", "thin")]
+    xs = [rng.uniform(0, world_size) for _ in range(n)]
+    ys = [rng.uniform(0, world_size) for _ in range(n)]
+    names, colors, textures = zip(*(tree_kinds[i % len(tree_kinds)] for i in range(n)))
+
+    start = time.perf_counter()
+    forest = Forest()
+    for i in range(n):
+        forest.plant_tree(xs[i], ys[i], names[i], colors[i], textures[i])
+    one_by_one_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    Forest().plant_many(xs, ys, names, colors, textures)
+    bulk_time = time.perf_counter() - start
+    print(f"Plant {n} trees: plant_tree {one_by_one_time * 1e3:.0f} ms, "
+          f"plant_many {bulk_time * 1e3:.0f} ms")
+
+# Benchmark: Khởi động world server – rebuild từ stream nhị phân so với Forest.open (mmap).
+
+
+def benchmark_open(n=500_000, world_size=10_000.0, seed=42):
+    rng = random.Random(seed)
+    forest = Forest()
+    forest.plant_many([rng.uniform(0, world_size) for _ in range(n)],
+                      [rng.uniform(0, world_size) for _ in range(n)],
+                      ["oak"] * n, ["green"] * n, ["rough"] * n)
+    with tempfile.TemporaryDirectory() as directory:
+        stream_path = os.path.join(directory, "forest.fts")
+        snapshot_path = os.path.join(directory, "forest.frsm")
+        forest.write_binary(stream_path)
+        forest.save(snapshot_path)
+
+        start = time.perf_counter()
+        Forest().load_binary(stream_path)
+        rebuild_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        opened = Forest.open(snapshot_path)
+        open_time = time.perf_counter() - start
+        opened.close()
+    print(f"Start forest of {n} trees: rebuild {rebuild_time * 1e3:.0f} ms, "
+          f"mmap open {open_time * 1e3:.2f} ms")
+
+# Benchmark: Vẽ 1 frame lên RasterCanvas – per-tree TreeType.draw so với batch theo TreeType.
+
+
+def benchmark_render(n=200_000, world_size=1_000.0, seed=42):
+    rng = random.Random(seed)
+    tree_kinds = [("oak", "green", "rough"), ("pine", "dark_green", "smooth"),
+                  ("birch", "white", "thin")]
+    forest = Forest()
+    for i in range(n):
+        forest.plant_tree(rng.uniform(0, world_size), rng.uniform(0, world_size),
+                          *tree_kinds[i % len(tree_kinds)])
+    canvas = RasterCanvas(int(world_size), int(world_size))
+
+    start = time.perf_counter()
+    for tree in forest:
+        tree.draw(canvas)
+    per_tree_time = time.perf_counter() - start
+
+    canvas.clear()
+    start = time.perf_counter()
+    forest.draw(canvas)
+    batched_time = time.perf_counter() - start
+    print(f"Render {n} trees to {canvas.width}x{canvas.height} canvas: "
+          f"per-tree {per_tree_time * 1e3:.0f} ms, batched {batched_time * 1e3:.0f} ms")
+
+# Benchmark: Query viewport bằng grid so với quét toàn bộ cột (chi phí/frame theo số cây thấy được).
+
+
+def benchmark_region_query(n=200_000, world_size=10_000.0, viewport=200.0, frames=200, seed=42):
+    rng = random.Random(seed)
+    forest = Forest()
+    for _ in range(n):
+        forest.plant_tree(rng.uniform(0, world_size), rng.uniform(0, world_size),
+                          "oak", "green", "rough")
+    cameras = [(rng.uniform(0, world_size - viewport), rng.uniform(0, world_size - viewport))
+               for _ in range(frames)]
+    forest._grid()  # Build grid trước (lazy) để chỉ đo chi phí query/frame.
+
+    start = time.perf_counter()
+    visible = 0
+    for cx, cy in cameras:
+        visible += sum(1 for _ in forest._indices_in_rect(cx, cy, cx + viewport, cy + viewport))
+    grid_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for cx, cy in cameras:
+        x1, y1 = cx + viewport, cy + viewport
+        sum(1 for x, y in zip(forest._xs, forest._ys) if cx <= x <= x1 and cy <= y <= y1)
+    scan_time = time.perf_counter() - start
+
+    print(f"Viewport query over {n} trees ({visible / frames:.0f} visible/frame): "
+          f"grid {grid_time / frames * 1e3:.3f} ms/frame, "
+          f"full scan {scan_time / frames * 1e3:.3f} ms/frame")
+
 
 # Sử dụng: Minh họa share flyweights.
 if __name__ == "__main__":
@@ -74,5 +866,47 @@ if __name__ == "__main__":
     forest.plant_tree(1, 2, "oak", "green", "rough")
     forest.plant_tree(3, 4, "oak", "green", "rough")  # Reuse!
     forest.plant_tree(5, 6, "pine", "dark_green", "smooth")  # New flyweight
+    print(f"TreeFactory stats: {TreeFactory.stats()}")  # hits=1, misses=2, size=2
 
     forest.draw("canvas")  # Draw toàn forest
+    forest.draw_region("canvas", 0, 0, 4, 4)  # Chỉ vẽ cây trong viewport camera.
+    print(f"Trees within 3 of (2, 3): {[(t.x, t.y) for t in forest.query_radius(2, 3, 3)]}")
+
+    canvas = RasterCanvas(12, 12)  # Canvas thật: buffer byte thay vì print.
+    forest.draw(canvas)  # Batch theo TreeType (2 batch: oak, pine).
+    print(f"Raster canvas: {sum(1 for p in canvas.pixels if p)} pixels painted")
+
+    # Bulk: mỗi bộ intrinsic chỉ resolve 1 lần (misses +1 cho "birch", không phải +3).
+    forest.plant_many([7, 8, 9], [1, 1, 1], ["birch"] * 3, ["white"] * 3, ["thin"] * 3)
+    print(f"Forest has {len(forest)} trees after plant_many, TreeFactory stats: {TreeFactory.stats()}")
+
+    # Eviction: pool weak – TreeType không còn ai dùng tự rời pool.
+    TreeFactory.set_eviction(True)
+    scratch = Forest()
+    scratch.plant_tree(0, 0, "palm", "yellow", "fibrous")
+    print(f"With a palm forest alive: size={TreeFactory.stats()['size']}")
+    del scratch
+    print(f"After dropping it: size={TreeFactory.stats()['size']}")
+
+    # Streaming world: chia forest thành chunk 4x4, camera đi qua – chỉ chunk gần camera resident.
+    with tempfile.TemporaryDirectory() as world_dir:
+        world = Forest()
+        world.plant_many([float(x) for x in range(0, 32, 2)], [float(y) for y in range(0, 32, 2)],
+                         ["oak"] * 16, ["green"] * 16, ["rough"] * 16)
+        ChunkedForest.build(world_dir, world, chunk_size=4.0)
+        streamed = ChunkedForest(world_dir, memory_budget=1500, load_radius=1)
+        for camera_x in (2.0, 14.0, 28.0):
+            streamed.update_camera(camera_x, camera_x)
+            streamed.wait_until_loaded()  # Demo: chờ nạp; game loop thật cứ vẽ tiếp.
+            frame = RasterCanvas(32, 32)
+            streamed.draw(frame)
+            print(f"Camera at ({camera_x}, {camera_x}): {streamed.stats()}")
+        streamed.close()
+
+    if "--bench" in sys.argv[1:]:
+        print()
+        benchmark_memory()
+        benchmark_planting()
+        benchmark_open()
+        benchmark_region_query()
+        benchmark_render()
@@ -1,4 +1,15 @@
 from abc import ABC, abstractmethod
+from collections import deque
+from threading import Condition, Event, Thread
+from typing import Callable, Dict, Iterable, Optional, Type
+import asyncio
+import contextlib
+import inspect
+import json
+import os
+import sys
+import tempfile
+import time
 
 
 # Service Interface (giao diện chung), Service (object gốc), Proxy (đại diện thay thế), Client (người dùng)
@@ -27,13 +38,136 @@ class RealSubject(Subject):
         print("RealSubject: Handling request.")
 
 
+class AccessLog:
+    """
+    A buffered access-log sink. append() only puts a structured record into a
+    bounded ring buffer; a background thread writes the records to `path` as
+    JSON lines, in batches of up to `batch_size`, at least every
+    `flush_interval` seconds.
+
+    Memory stays bounded by `capacity` records. When the buffer is full the
+    `policy` decides: "drop" discards the new record (counted in `dropped`)
+    so the request path never waits, "block" makes the caller wait for the
+    writer to catch up so no record is lost.
+    """
+
+    DROP = "drop"
+    BLOCK = "block"
+
+    def __init__(self, path: str, capacity: int = 8192, policy: str = DROP,
+                 batch_size: int = 512, flush_interval: float = 0.1) -> None:
+        if policy not in (self.DROP, self.BLOCK):
+            raise ValueError(f"Unknown policy: {policy!r}")
+        self.path = path
+        self.capacity = capacity
+        self.policy = policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._buffer: deque = deque()  # deque.append/popleft are atomic - no lock while there is room.
+        self._not_full = Condition()  # Only taken when the buffer is full.
+        self._wake = Event()  # Wakes the writer early once a full batch (or a full buffer) is waiting.
+        self._wake_at = min(batch_size, capacity)
+        self._closed = False
+        self._encode = json.JSONEncoder(check_circular=False).encode
+        self._file = open(path, "a", encoding="utf-8")
+        self._writer = Thread(target=self._write_loop, name="access-log", daemon=True)
+        self._writer.start()
+
+    def append(self, event: str, **fields) -> bool:
+        """
+        Queues one record; returns False if it was dropped (buffer full under
+        the "drop" policy, or the log is already closed). Encoding and I/O
+        happen on the writer thread.
+        """
+
+        if self._closed:
+            self.dropped += 1  # The writer has stopped - the record would never reach the file.
+            return False
+        buffer = self._buffer
+        if len(buffer) >= self.capacity:
+            with self._not_full:
+                while len(buffer) >= self.capacity:
+                    if self.policy == self.DROP or self._closed:
+                        self.dropped += 1
+                        return False
+                    self._wake.set()  # The writer may be sleeping out flush_interval - it is the one that makes room.
+                    self._not_full.wait()
+        record = (time.time(), event, fields)
+        buffer.append(record)
+        if len(buffer) == self._wake_at:
+            self._wake.set()
+        if self._closed:
+            return self._settle_after_close(record)
+        return True
+
+    def _settle_after_close(self, record: tuple) -> bool:
+        # close() started between the _closed check and the enqueue. Its final drain runs under _not_full,
+        # so here it has either not run yet (the record will be written) or already run (the record may
+        # still sit in the buffer - take it back and report it as dropped).
+        with self._not_full:
+            if not self._file.closed:
+                return True
+            try:
+                self._buffer.remove(record)
+            except ValueError:
+                return True  # The final drain wrote it.
+            self.dropped += 1
+            return False
+
+    def _write_loop(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            closed = self._closed
+            self._drain()
+            if closed:
+                return
+
+    def _drain(self) -> None:
+        buffer = self._buffer
+        while buffer:
+            batch = [buffer.popleft() for _ in range(min(self.batch_size, len(buffer)))]
+            with self._not_full:
+                self._not_full.notify_all()  # Room again for callers blocked on a full buffer.
+            encode = self._encode
+            self._file.write("".join(encode({"ts": ts, "event": event, **fields}) + "\n"
+                                     for ts, event, fields in batch))
+            self.written += len(batch)
+        self._file.flush()
+
+    def close(self) -> None:
+        """
+        Writes everything still buffered, then closes the file.
+        """
+
+        with self._not_full:
+            if self._closed:
+                return
+            self._closed = True
+            self._not_full.notify_all()
+        self._wake.set()
+        self._writer.join()
+        with self._not_full:
+            self._drain()  # Records from appends that passed the _closed check just before close().
+            self._file.close()
+
+    def __enter__(self) -> "AccessLog":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
 class Proxy(Subject):
     """
     The Proxy has an interface identical to the RealSubject.
     """
 
-    def __init__(self, real_subject: RealSubject) -> None:
+    def __init__(self, real_subject: RealSubject, access_log: Optional[AccessLog] = None) -> None:
         self._real_subject = real_subject
+        self._access_log = access_log
 
     def request(self) -> None:
         """
@@ -48,11 +182,150 @@ class Proxy(Subject):
             self.log_access()
 
     def check_access(self) -> bool:
-        print("Proxy: Checking access prior to firing a real request.")
+        if self._access_log is not None:
+            self._access_log.append("check_access", subject=type(self._real_subject).__name__)
+        else:
+            print("Proxy: Checking access prior to firing a real request.")
         return True
 
     def log_access(self) -> None:
-        print("Proxy: Logging the time of request.", end="")
+        if self._access_log is not None:
+            self._access_log.append("request", subject=type(self._real_subject).__name__)
+        else:
+            print("Proxy: Logging the time of request.", end="")
+
+
+MEMOIZE = "memoize"
+TIME = "time"
+CHECK_ACCESS = "check_access"
+POLICIES = (CHECK_ACCESS, MEMOIZE, TIME)
+
+
+def _signature_source(name: str, function: Callable, namespace: Dict[str, object]) -> tuple:
+    """
+    Returns the parameter list, the call arguments and the memo key expression
+    for a generated method with the same signature as `function`. Default
+    values are passed through `namespace` instead of being written as source.
+    """
+
+    params, args, key_parts = [], [], []
+    keyword_only = False
+    for parameter in list(inspect.signature(function).parameters.values())[1:]:
+        source = parameter.name
+        if parameter.kind is parameter.VAR_POSITIONAL:
+            source = "*" + source
+            keyword_only = True
+            args.append(source)
+            key_parts.append(f"({parameter.name},)")
+        elif parameter.kind is parameter.VAR_KEYWORD:
+            source = "**" + source
+            args.append(source)
+            key_parts.append(f"(tuple(sorted({parameter.name}.items())),)")
+        else:
+            if parameter.kind is parameter.KEYWORD_ONLY:
+                if not keyword_only:
+                    params.append("*")
+                    keyword_only = True
+                args.append(f"{parameter.name}={parameter.name}")
+            else:
+                args.append(parameter.name)
+            key_parts.append(f"({parameter.name},)")
+        if parameter.default is not parameter.empty:
+            namespace[f"_default_{name}_{parameter.name}"] = parameter.default
+            source += f"=_default_{name}_{parameter.name}"
+        params.append(source)
+    key = " + ".join(key_parts) if key_parts else "()"
+    return ", ".join(["self"] + params), ", ".join(args), key
+
+
+def make_proxy(interface: Type[ABC], policies: Optional[Dict[str, Iterable[str]]] = None,
+               name: Optional[str] = None) -> type:
+    """
+    Generates a Proxy class for any interface (Subject, ThirdPartyYouTubeLib,
+    PaymentInterface, ...). Every public method of the interface gets its own
+    generated method - there is no per-call __getattr__ lookup or policy loop.
+
+    `policies` maps a method name to the policies applied to it, in the fixed
+    order check_access -> memoize -> time:
+      - check_access: calls `check_access(method_name)` first and raises
+        PermissionError when it returns False;
+      - memoize: caches results per argument tuple (arguments must be
+        hashable); clear_memo() empties the caches;
+      - time: adds the call count and seconds to `timings[method_name]`.
+
+    Methods without policies are bound straight to the real subject when the
+    proxy is created, so calling them costs exactly the same as calling the
+    real subject.
+
+    `async def` methods get an `async def` wrapper that awaits the real
+    subject, so memoize caches the awaited result and time measures the whole
+    await. Policies on generator methods (sync or async) are rejected: the
+    generator object would be cached and only its creation would be timed.
+    """
+
+    policies = {method: tuple(applied) for method, applied in (policies or {}).items()}
+    methods = sorted(attribute for attribute in dir(interface)
+                     if not attribute.startswith("_") and inspect.isfunction(getattr(interface, attribute)))
+    for method, applied in policies.items():
+        if method not in methods:
+            raise ValueError(f"{interface.__name__} has no method {method!r}")
+        unknown = set(applied) - set(POLICIES)
+        if unknown:
+            raise ValueError(f"Unknown policies for {method}: {sorted(unknown)}")
+        function = getattr(interface, method)
+        if applied and (inspect.isgeneratorfunction(function) or inspect.isasyncgenfunction(function)):
+            raise ValueError(f"Policies cannot be applied to generator method {method}")
+
+    namespace: Dict[str, object] = {"_perf_counter": time.perf_counter, "_allow_all": lambda method: True}
+    init = ["def __init__(self, real_subject, check_access=_allow_all):",
+            "    self._real_subject = real_subject",
+            "    self._check_access = check_access",
+            "    self.timings = {}"]
+    source = []
+    for method in methods:
+        applied = policies.get(method, ())
+        function = getattr(interface, method)
+        params, args, key = _signature_source(method, function, namespace)
+        call = f"self._real_subject.{method}({args})"
+        define = "def"
+        if inspect.iscoroutinefunction(function):
+            # Coroutine: await trong wrapper – memo giữ kết quả (không phải coroutine), time đo cả lúc chờ.
+            define, call = "async def", f"await {call}"
+        if not applied:
+            # Passthrough: bound method của real subject gắn thẳng vào instance.
+            init.append(f"    self.{method} = real_subject.{method}")
+            source += [f"{define} {method}({params}):", f"    return {call}", ""]
+            continue
+        body = []
+        if CHECK_ACCESS in applied:
+            body += [f"    if not self._check_access({method!r}):",
+                     f"        raise PermissionError('Access denied: {method}')"]
+        if MEMOIZE in applied:
+            init.append(f"    self._memo_{method} = {{}}")
+            body += [f"    __key = {key}",
+                     f"    __memo = self._memo_{method}",
+                     "    if __key in __memo:",
+                     "        return __memo[__key]"]
+        if TIME in applied:
+            init.append(f"    self.timings[{method!r}] = self._timing_{method} = [0, 0.0]")
+            body += ["    __start = _perf_counter()",
+                     f"    __value = {call}",
+                     f"    __timing = self._timing_{method}",
+                     "    __timing[0] += 1",
+                     "    __timing[1] += _perf_counter() - __start"]
+        else:
+            body.append(f"    __value = {call}")
+        if MEMOIZE in applied:
+            body.append("    __memo[__key] = __value")
+        body.append("    return __value")
+        source += [f"{define} {method}({params}):"] + body + [""]
+    memos = [f"self._memo_{method}.clear()" for method, applied in policies.items() if MEMOIZE in applied]
+    source += ["def clear_memo(self):"] + [f"    {line}" for line in memos or ["pass"]]
+    code = "\n".join(init + [""] + source) + "\n"
+    exec(compile(code, f"<proxy for {interface.__name__}>", "exec"), namespace)
+    members = {attribute: namespace[attribute] for attribute in methods + ["__init__", "clear_memo"]}
+    members["__source__"] = code  # Để debug: xem đúng code đã sinh.
+    return type(name or f"{interface.__name__}Proxy", (interface,), members)
 
 
 def client_code(subject: Subject) -> None:
@@ -71,6 +344,110 @@ def client_code(subject: Subject) -> None:
     # ...
 
 
+class AsyncSubject(ABC):
+    """
+    An asyncio flavour of the Subject interface - make_proxy generates
+    `async def` wrappers for its coroutine methods.
+    """
+
+    @abstractmethod
+    async def fetch(self, key: str) -> str:
+        pass
+
+
+class AsyncRealSubject(AsyncSubject):
+    """
+    A slow asyncio RealSubject - every fetch waits on the "network".
+    """
+
+    async def fetch(self, key: str) -> str:
+        await asyncio.sleep(0.1)  # Upstream chậm (network).
+        print(f"AsyncRealSubject: Fetching {key}.")
+        return key.upper()
+
+
+async def async_client_code(subject: AsyncSubject) -> None:
+    results = [await subject.fetch("report") for _ in range(2)]
+    print(f"Async client: got {results}")
+
+
+class QuietSubject(Subject):
+    """
+    A RealSubject without the print - the benchmark measures the proxy, not
+    the terminal.
+    """
+
+    def request(self) -> None:
+        pass
+
+
+class GetattrProxy:
+    """
+    The generic alternative to generated proxies: forwards every attribute
+    through __getattr__ on each call.
+    """
+
+    def __init__(self, real_subject: Subject) -> None:
+        self._real_subject = real_subject
+
+    def __getattr__(self, name: str):
+        return getattr(self._real_subject, name)
+
+
+def benchmark_generated_proxy(calls: int = 1_000_000, repeat: int = 5) -> None:
+    real = QuietSubject()
+    candidates = {
+        "RealSubject directly": real,
+        "generated, no policy": make_proxy(Subject)(real),
+        "__getattr__ proxy": GetattrProxy(real),
+        "generated, time": make_proxy(Subject, {"request": (TIME,)})(real),
+        "generated, check_access + time": make_proxy(Subject, {"request": (CHECK_ACCESS, TIME)})(real),
+    }
+    baseline = None
+    for label, subject in candidates.items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(calls):
+                subject.request()
+            best = min(best, time.perf_counter() - start)
+        per_call = best / calls * 1e9
+        baseline = per_call if baseline is None else baseline
+        print(f"{label}: {per_call:.0f} ns/call (+{per_call - baseline:.0f} ns)")
+
+
+def _slow_reader(fd: int, chunk: int = 4096, pause: float = 0.001) -> None:
+    # A slow consumer (terminal, log shipper): once the pipe buffer is full, every print waits for it.
+    with os.fdopen(fd, "rb", buffering=0) as pipe:
+        while pipe.read(chunk):
+            time.sleep(pause)
+
+
+def benchmark_access_log(requests: int = 100_000) -> None:
+    read_fd, write_fd = os.pipe()
+    reader = Thread(target=_slow_reader, args=(read_fd,), daemon=True)
+    reader.start()
+    with open(write_fd, "w", buffering=1, encoding="utf-8") as pipe, contextlib.redirect_stdout(pipe):
+        proxy = Proxy(QuietSubject())
+        start = time.perf_counter()
+        for _ in range(requests):
+            proxy.request()
+        printed = time.perf_counter() - start
+    reader.join()
+    print(f"Proxy printing to a slow pipe: {requests / printed:,.0f} requests/s")
+    with tempfile.TemporaryDirectory() as directory:
+        for policy in (AccessLog.DROP, AccessLog.BLOCK):
+            access_log = AccessLog(os.path.join(directory, f"access_{policy}.log"), policy=policy)
+            proxy = Proxy(QuietSubject(), access_log)
+            start = time.perf_counter()
+            for _ in range(requests):
+                proxy.request()
+            elapsed = time.perf_counter() - start
+            access_log.close()
+            print(f"Proxy with AccessLog ({policy}): {requests / elapsed:,.0f} requests/s, "
+                  f"{access_log.written:,} records written, {access_log.dropped:,} dropped")
+
+
 if __name__ == "__main__":
     print("Client: Executing the client code with a real subject:")
     real_subject = RealSubject()
@@ -81,3 +458,32 @@ if __name__ == "__main__":
     print("Client: Executing the same client code with a proxy:")
     proxy = Proxy(real_subject)
     client_code(proxy)
+
+    print("\n")
+
+    print("Client: Executing the same client code with a generated proxy:")
+    GeneratedProxy = make_proxy(Subject, {"request": (CHECK_ACCESS, TIME)})
+    generated = GeneratedProxy(real_subject, check_access=lambda method: True)
+    client_code(generated)
+    print(f"Generated proxy timings: {generated.timings}")
+
+    print("")
+
+    print("Client: Executing async client code with a generated memoizing proxy:")
+    async_generated = make_proxy(AsyncSubject, {"fetch": (MEMOIZE, TIME)})(AsyncRealSubject())
+    asyncio.run(async_client_code(async_generated))  # Lần 2 lấy từ memo, không gọi upstream.
+    print(f"Generated async proxy timings: {async_generated.timings}")
+
+    print("\n")
+
+    print("Client: Executing the same client code with a proxy and a buffered access log:")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "access.log")
+        with AccessLog(path) as access_log:
+            client_code(Proxy(real_subject, access_log))
+        with open(path, encoding="utf-8") as f:
+            print(f"Access log: {f.read().strip()}")
+
+    if "--bench" in sys.argv[1:]:
+        benchmark_generated_proxy()
+        benchmark_access_log()
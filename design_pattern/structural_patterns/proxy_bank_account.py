@@ -22,6 +22,15 @@ Code Python đơn giản: Giả lập trừ tiền, với PIN check và limit. C
 # Service Interface (giao diện chung), Service (object gốc), Proxy (đại diện thay thế), Client (người dùng)
 
 from abc import ABC, abstractmethod
+from threading import Condition, Event, Lock, Thread
+from typing import Dict, List, Optional, Tuple
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import zlib
 
 # SERVICE INTERFACE: PaymentInterface – Giao diện chung cho proxy/service (thanh toán).
 # ÁNH XẠ ĐƠN: Đây là "cầu nối" – định nghĩa method thanh toán chung, proxy "giả dạng" service.
@@ -35,61 +44,342 @@ class PaymentInterface(ABC):
         # Method chung: Thanh toán số tiền (trả status), pin optional cho proxy.
         pass
 
+# LEDGER: Write-ahead log cho BankAccount – balance không chỉ nằm trong memory (crash là mất mọi payment).
+# ÁP DỤNG: Group commit – payment chỉ trả "successful" sau khi record đã fsync; writer thread gom mọi record đến
+# trong batch_window rồi ghi + 1 fsync cho cả batch (N payment đồng thời ≈ 1 fsync thay vì N).
+# BẢN CHẤT: Log append-only "seq account delta crc"; snapshot (balances + seq) định kỳ rồi cắt log → recovery
+# = đọc snapshot + replay phần log sau nó (thời gian replay bị chặn bởi snapshot_every). Dòng cuối ghi dở
+# (crash giữa write) bị phát hiện bằng CRC và cắt bỏ – nó chưa từng được xác nhận cho client. seq tăng dần
+# nhưng có thể hở (batch ghi lỗi bị bỏ, payment đã hoàn tiền).
+# SỬA LỖI: Snapshot lỗi (đĩa đầy...) không được giết writer – log vẫn đủ để recover, chỉ in lỗi và thử lại sau
+# snapshot_every record nữa. Writer chết vì bất kỳ lý do nào thì mọi commit đang chờ và mọi submit sau đó đều
+# lỗi ngay (không treo vĩnh viễn trong commit.wait()).
+# SỬA LỖI: account_id không được chứa whitespace/ký tự điều khiển – "\n" trong id tách 1 record thành 2 dòng
+# hỏng, recovery cắt mất mọi record đã commit phía sau.
+
+
+class _Commit:
+    # 1 batch group commit: các payment trong batch chờ cùng 1 Event.
+    def __init__(self):
+        self.done = Event()
+        self.error: Optional[BaseException] = None
+
+    def wait(self) -> None:
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class Ledger:
+    LOG_FILE = "ledger.log"
+    SNAPSHOT_FILE = "snapshot.json"
+
+    def __init__(self, directory: str, batch_window: float = 0.002, snapshot_every: int = 10_000):
+        self.directory = directory
+        self.batch_window = batch_window  # Giây chờ gom thêm record sau record đầu tiên của batch.
+        self.snapshot_every = snapshot_every  # Số record giữa 2 snapshot.
+        os.makedirs(directory, exist_ok=True)
+        self._log_path = os.path.join(directory, self.LOG_FILE)
+        self._snapshot_path = os.path.join(directory, self.SNAPSHOT_FILE)
+        self._balances, self._seq, replayed = self._recover()  # Trạng thái đã commit (durable).
+        self._since_snapshot = replayed
+        self._log = open(self._log_path, "ab")
+        self._cond = Condition()
+        self._pending: List[Tuple[int, str, float]] = []
+        self._commit = _Commit()
+        self._next_seq = self._seq + 1
+        self._opening: Dict[str, _Commit] = {}  # Tài khoản có record mở chưa commit -> commit của record đó.
+        self._closed = False
+        self._failed: Optional[BaseException] = None  # Lý do writer chết (None = đang chạy).
+        self.commits = 0  # Số lần fsync (batch).
+        self.records = 0
+        self._writer = Thread(target=self._write_loop, name="ledger-writer", daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def _encode(seq: int, account_id: str, delta: float) -> bytes:
+        payload = f"{seq} {account_id} {delta!r}"
+        return f"{payload} {zlib.crc32(payload.encode()):08x}\n".encode()
+
+    def _recover(self) -> Tuple[Dict[str, float], int, int]:
+        balances: Dict[str, float] = {}
+        seq = 0
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            balances, seq = snapshot["balances"], snapshot["seq"]
+        replayed = 0
+        if not os.path.exists(self._log_path):
+            return balances, seq, replayed
+        with open(self._log_path, "r+b") as f:
+            offset = 0
+            for line in f:
+                try:
+                    payload, crc = line.rstrip(b"\n").rsplit(b" ", 1)
+                    valid = line.endswith(b"\n") and int(crc, 16) == zlib.crc32(payload)
+                    record_seq, account_id, delta = payload.decode().split(" ")
+                    record_seq, delta = int(record_seq), float(delta)
+                except ValueError:
+                    valid = False
+                if not valid:
+                    break  # Đuôi ghi dở (hoặc hỏng): chưa từng được xác nhận – cắt từ đây.
+                offset += len(line)
+                if record_seq <= seq:
+                    continue  # Đã nằm trong snapshot (crash giữa snapshot và cắt log).
+                balances[account_id] = balances.get(account_id, 0) + delta
+                seq = record_seq
+                replayed += 1
+            f.truncate(offset)
+        return balances, seq, replayed
+
+    def open_account(self, account_id: str, balance: float) -> float:
+        # Tài khoản đã có trong ledger (sau restart) → trả balance đã recover, bỏ qua balance truyền vào.
+        if not account_id or any(char.isspace() or not char.isprintable() for char in account_id):
+            raise ValueError(f"Invalid account id: {account_id!r}")
+        with self._cond:
+            if account_id in self._balances:
+                return self._balances[account_id]
+            commit = self._opening.get(account_id)
+            if commit is None:
+                # Số dư mở tài khoản = record đầu tiên; caller khác mở cùng id chờ chung commit này.
+                commit = self._opening[account_id] = self.submit(account_id, balance)
+        try:
+            commit.wait()
+        finally:
+            with self._cond:
+                if self._opening.get(account_id) is commit:
+                    del self._opening[account_id]  # Lỗi thì lần mở sau submit lại.
+        with self._cond:
+            return self._balances[account_id]
+
+    def submit(self, account_id: str, delta: float) -> _Commit:
+        # Xếp record vào batch đang mở, trả _Commit để chờ fsync. Gọi dưới lock của tài khoản → thứ tự
+        # record trong log khớp thứ tự thay đổi balance trong memory.
+        with self._cond:
+            if self._failed is not None:
+                raise RuntimeError("Ledger writer failed") from self._failed
+            if self._closed:
+                raise RuntimeError("Ledger is closed")
+            self._pending.append((self._next_seq, account_id, delta))
+            self._next_seq += 1
+            self._cond.notify()
+            return self._commit
+
+    def _write_loop(self) -> None:
+        commit = None  # Commit của batch đang ghi – phải được báo lỗi nếu writer chết giữa chừng.
+        try:
+            while True:
+                with self._cond:
+                    while not self._pending and not self._closed:
+                        self._cond.wait()
+                    if not self._pending:
+                        return
+                if self.batch_window:
+                    time.sleep(self.batch_window)  # Gom thêm payment đến trong cửa sổ.
+                with self._cond:
+                    batch, self._pending = self._pending, []
+                    commit, self._commit = self._commit, _Commit()
+                position = self._log.tell()
+                try:
+                    self._log.write(b"".join(self._encode(*record) for record in batch))
+                    self._log.flush()
+                    os.fsync(self._log.fileno())
+                except OSError as exc:
+                    try:
+                        self._log.truncate(position)  # Bỏ phần batch lỗi đã lỡ ghi (nếu còn truncate được).
+                    except OSError:
+                        pass  # Recovery vẫn cắt đuôi hỏng theo CRC.
+                    commit.error = exc
+                    commit.done.set()
+                    commit = None
+                    continue
+                with self._cond:  # balances()/open_account đọc _balances dưới cùng lock.
+                    for seq, account_id, delta in batch:
+                        self._balances[account_id] = self._balances.get(account_id, 0) + delta
+                    self._seq = batch[-1][0]
+                self.commits += 1
+                self.records += len(batch)
+                commit.done.set()
+                commit = None
+                self._since_snapshot += len(batch)
+                if self._since_snapshot >= self.snapshot_every:
+                    try:
+                        self._write_snapshot()
+                    except OSError as exc:
+                        # Log vẫn còn nguyên (chỉ cắt sau khi snapshot đã os.replace) – không mất record nào.
+                        print(f"Ledger: snapshot failed, keeping the log: {exc!r}")
+                    self._since_snapshot = 0  # Thử lại sau snapshot_every record nữa.
+        except BaseException as exc:
+            error = RuntimeError("Ledger writer failed")
+            error.__cause__ = exc
+            with self._cond:
+                self._failed = exc
+                self._pending = []
+                waiting, self._commit = self._commit, _Commit()
+            for failed in (commit, waiting):
+                if failed is not None:
+                    failed.error = error
+                    failed.done.set()
+            raise
+
+    def _write_snapshot(self) -> None:
+        # Snapshot atomic (tmp + fsync + os.replace) rồi mới cắt log – crash ở giữa: replay bỏ qua seq cũ.
+        # Chỉ writer thread sửa _balances → đọc ở đây không cần lock.
+        tmp = self._snapshot_path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"seq": self._seq, "balances": self._balances}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._snapshot_path)
+        except OSError:
+            try:
+                os.remove(tmp)  # Bỏ snapshot ghi dở (nếu có).
+            except OSError:
+                pass
+            raise
+        self._log.truncate(0)
+        self._log.seek(0)
+
+    def balances(self) -> Dict[str, float]:
+        # Balance đã durable (đã fsync) theo từng tài khoản.
+        with self._cond:
+            return dict(self._balances)
+
+    def close(self) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._writer.join()
+        self._log.close()
+
 # SERVICE: BankAccount – Object gốc chứa business logic (trừ tiền thực từ tài khoản).
 # ÁNH XẠ ĐƠN: Đây là "tài khoản ngân hàng" – logic chính (trừ balance), chậm/tốn nếu connect DB thực.
 # BẢN CHẤT: Service không biết proxy – chỉ trừ tiền; proxy delegate sau khi kiểm tra (auth/limit).
 # SỬA LỖI: Thêm optional `pin` (ignore) để khớp interface – không ảnh hưởng logic gốc.
+# SỬA LỖI: Check + trừ balance là read-modify-write – 2 thread checkout cùng lúc có thể cùng thấy đủ tiền
+# và cùng trừ (hoặc mất 1 lần trừ). Mỗi tài khoản giữ 1 lock riêng (fine-grained): thanh toán trên các tài
+# khoản khác nhau không chặn nhau; print nằm ngoài lock (I/O chậm không kéo dài critical section).
+# ÁP DỤNG: ledger=Ledger – submit record rồi mới trừ tiền, cả 2 dưới lock; chờ fsync NGOÀI lock (payment khác
+# cùng tài khoản vào chung batch). submit lỗi (ledger đã đóng) thì balance chưa hề đổi; commit lỗi vì bất kỳ
+# lý do nào thì hoàn tiền trước khi báo thất bại.
 
 
 class BankAccount(PaymentInterface):
-    def __init__(self, balance: float):
+    def __init__(self, balance: float, verbose: bool = True, ledger: Optional[Ledger] = None,
+                 account_id: str = "main"):
+        self.ledger = ledger  # None: balance chỉ nằm trong memory.
+        self.account_id = account_id
+        if ledger is not None:
+            balance = ledger.open_account(account_id, balance)  # Restart: dùng balance đã recover.
         self.balance = balance  # Số dư tài khoản.
+        self.verbose = verbose  # False: không print (benchmark/production).
+        self._lock = Lock()  # Bảo vệ balance.
 
     def make_payment(self, amount: float, pin: str = "") -> str:
         # Logic thực: Trừ tiền nếu đủ (pin ignored ở service).
-        if self.balance >= amount:
-            self.balance -= amount
-            print(
-                f"Service (BankAccount): Deducted {amount} from balance. New balance: {self.balance}")
+        commit = None
+        with self._lock:
+            paid = self.balance >= amount
+            if paid:
+                if self.ledger is not None:
+                    try:
+                        commit = self.ledger.submit(self.account_id, -amount)
+                    except RuntimeError:
+                        return "Payment failed - ledger unavailable"
+                self.balance -= amount
+            balance = self.balance
+        if commit is not None:
+            try:
+                commit.wait()  # Chỉ xác nhận sau khi record đã fsync.
+            except BaseException as exc:
+                with self._lock:
+                    self.balance += amount
+                if isinstance(exc, (OSError, RuntimeError)):
+                    return "Payment failed - ledger unavailable"
+                raise
+        if paid:
+            if self.verbose:
+                print(
+                    f"Service (BankAccount): Deducted {amount} from balance. New balance: {balance}")
             return "Payment successful"
         else:
-            print(
-                f"Service (BankAccount): Insufficient funds. Balance: {self.balance}")
+            if self.verbose:
+                print(
+                    f"Service (BankAccount): Insufficient funds. Balance: {balance}")
             return "Payment failed - insufficient funds"
 
+    def deposit(self, amount: float) -> None:
+        # Hoàn tiền / nạp tiền – cùng lock với make_payment.
+        commit = None
+        with self._lock:
+            if self.ledger is not None:
+                commit = self.ledger.submit(self.account_id, amount)  # Lỗi ở đây: balance chưa đổi.
+            self.balance += amount
+        if commit is not None:
+            try:
+                commit.wait()
+            except BaseException:
+                with self._lock:
+                    self.balance -= amount
+                raise
+
 # PROXY: CreditCard – Đại diện thay thế, wrap service và thêm logic (auth/check limit).
 # ÁNH XẠ ĐƠN: Đây là "thẻ tín dụng" – giữ ref đến tài khoản (wrappee), kiểm tra PIN/limit trước delegate.
 # BẢN CHẤT: Proxy thêm behaviors (auth trước, log sau) – kiểm soát access, client thấy như service thật.
+# SỬA LỖI: Check limit rồi mới trừ sau khi account trả lời – các thread cùng thẻ đều qua check và vượt limit.
+# Giờ giữ chỗ (reserve) limit ngay dưới lock của thẻ, gọi account ngoài lock (không bao giờ giữ 2 lock cùng
+# lúc → không deadlock), account từ chối thì hoàn lại phần limit đã giữ.
+# SỬA LỖI: Account ném exception (ledger đã đóng, lỗi DB...) cũng phải hoàn limit – nếu không, phần đã giữ chỗ
+# bị mất vĩnh viễn dù không có tiền nào rời tài khoản.
 
 
 class CreditCard(PaymentInterface):
-    def __init__(self, account: PaymentInterface, card_limit: float, pin: str):
+    def __init__(self, account: PaymentInterface, card_limit: float, pin: str, verbose: bool = True):
         self.account = account  # Wrappee ref – "bọc" tài khoản ngân hàng.
         self.card_limit = card_limit  # Limit thẻ (e.g., 1000 USD).
         self.pin = pin  # PIN để auth.
         self.remaining_limit = card_limit  # Số dư limit hiện tại.
+        self.verbose = verbose  # False: không print (benchmark/production).
+        self._lock = Lock()  # Bảo vệ remaining_limit.
 
     def make_payment(self, amount: float, provided_pin: str = "") -> str:
         # Thêm logic trước delegate: Check auth (PIN) và limit.
         if provided_pin != self.pin:
-            print("Proxy (CreditCard): Authentication failed - Wrong PIN!")
+            if self.verbose:
+                print("Proxy (CreditCard): Authentication failed - Wrong PIN!")
             return "Payment failed - Invalid PIN"
-        if amount > self.remaining_limit:
-            print(
-                f"Proxy (CreditCard): Limit exceeded! Requested: {amount}, Limit: {self.remaining_limit}")
+        with self._lock:
+            limit = self.remaining_limit
+            reserved = amount <= limit
+            if reserved:
+                self.remaining_limit -= amount  # Giữ chỗ trước khi delegate.
+        if not reserved:
+            if self.verbose:
+                print(
+                    f"Proxy (CreditCard): Limit exceeded! Requested: {amount}, Limit: {limit}")
             return "Payment failed - Limit exceeded"
 
         # Delegate đến service sau check.
         # Trừ tiền từ tài khoản (pass pin nếu cần).
-        result = self.account.make_payment(amount, provided_pin)
+        try:
+            result = self.account.make_payment(amount, provided_pin)
+        except BaseException:
+            with self._lock:
+                self.remaining_limit += amount
+            raise
 
-        # Thêm logic sau delegate: Update limit và log.
+        # Thêm logic sau delegate: Giữ phần limit đã reserve nếu thành công, hoàn lại nếu không.
         if "successful" in result:
-            self.remaining_limit -= amount
-            print(
-                f"Proxy (CreditCard): Payment approved. New limit: {self.remaining_limit}")
+            if self.verbose:
+                print(
+                    f"Proxy (CreditCard): Payment approved. New limit: {self.remaining_limit}")
             return "Payment successful via credit card"
         else:
+            with self._lock:
+                self.remaining_limit += amount
             return result  # Trả lỗi từ service.
 
 # CLIENT: ShopOwner – Người dùng cuối, dùng qua interface (pass proxy thay service).
@@ -107,6 +397,83 @@ class ShopOwner:
         print(f"Client (ShopOwner): Sale processed: {result}")
 
 
+# BENCHMARK: Nhiều thread checkout đồng thời trên nhiều thẻ/tài khoản (amount là số nguyên → so sánh chính xác).
+# Kiểm tra bảo toàn: tiền rời tài khoản = tổng thanh toán thành công = limit đã dùng; không balance/limit âm.
+
+
+def benchmark_concurrent_payments(thread_counts=(1, 2, 4, 8), payments: int = 200_000,
+                                  accounts: int = 64, balance: int = 40_000, limit: int = 30_000,
+                                  seed: int = 42) -> None:
+    for threads in thread_counts:
+        bank = [BankAccount(balance, verbose=False) for _ in range(accounts)]
+        cards = [CreditCard(account, limit, "1234", verbose=False) for account in bank]
+        succeeded = [0] * threads  # Tổng amount thành công theo thread (không chia sẻ – không cần lock).
+
+        def checkout(index: int) -> None:
+            rng = random.Random(seed + index)
+            total = 0
+            for _ in range(payments // threads):
+                amount = rng.randint(1, 20)
+                if "successful" in rng.choice(cards).make_payment(amount, "1234"):
+                    total += amount
+            succeeded[index] = total
+
+        workers = [Thread(target=checkout, args=(i,)) for i in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        debited = sum(balance - account.balance for account in bank)
+        used = sum(limit - card.remaining_limit for card in cards)
+        assert debited == used == sum(succeeded), (debited, used, sum(succeeded))
+        assert all(account.balance >= 0 for account in bank) and all(card.remaining_limit >= 0 for card in cards)
+        print(f"{threads} thread(s): {payments // threads * threads / elapsed:,.0f} payments/s "
+              f"({sum(succeeded):,} charged, balances conserved)")
+
+
+# BENCHMARK: Payments/sec theo batch_window của ledger – nhiều thread checkout, mỗi payment chờ fsync.
+# Mốc so sánh: 1 thread = mỗi payment 1 fsync riêng (không có gì để gom). Cửa sổ lớn hơn → batch lớn hơn, ít
+# fsync hơn, nhưng mỗi payment chờ lâu hơn – chỉ đáng khi fsync đắt hơn cửa sổ.
+
+
+def _run_ledger_checkout(window: float, threads: int, payments: int, accounts: int, seed: int) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        ledger = Ledger(directory, batch_window=window)
+        bank = [BankAccount(1_000_000, verbose=False, ledger=ledger, account_id=f"acct{i}")
+                for i in range(accounts)]
+        commits_before = ledger.commits
+
+        def checkout(index: int) -> None:
+            rng = random.Random(seed + index)
+            for _ in range(payments // threads):
+                rng.choice(bank).make_payment(rng.randint(1, 20))
+
+        workers = [Thread(target=checkout, args=(i,)) for i in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        commits = ledger.commits - commits_before
+        ledger.close()
+        recovered = Ledger(directory).balances()  # Replay phải ra đúng balance trong memory.
+        assert recovered == {account.account_id: account.balance for account in bank}
+        done = payments // threads * threads
+        print(f"{threads} thread(s), batch_window {window * 1e3:g}ms: {done / elapsed:,.0f} payments/s, "
+              f"{commits:,} fsyncs ({done / commits:.1f} payments per fsync), recovery OK")
+
+
+def benchmark_ledger(batch_windows=(0.0, 0.0002, 0.001, 0.005), threads: int = 64, payments: int = 20_000,
+                     accounts: int = 64, seed: int = 42) -> None:
+    _run_ledger_checkout(0.0, 1, payments // 4, accounts, seed)
+    for window in batch_windows:
+        _run_ledger_checkout(window, threads, payments, accounts, seed)
+
+
 # SỬ DỤNG: Ý NGHĨA CỐT LÕI CHUNG – App config proxy động (thẻ = proxy wrap account) – client pass proxy như service.
 if __name__ == "__main__":
     # Real service (tài khoản trực tiếp – không check PIN/limit)
@@ -125,3 +492,21 @@ if __name__ == "__main__":
     shop_card.process_sale(400.0, "wrong")
     # Limit vượt → từ chối trước delegate.
     shop_card.process_sale(600.0, "1234")
+
+    print("\n=== Write-ahead ledger (balances survive a crash) ===")
+    with tempfile.TemporaryDirectory() as directory:
+        ledger = Ledger(directory)
+        durable = BankAccount(1000.0, ledger=ledger, account_id="alice")
+        ShopOwner(CreditCard(durable, 500.0, "1234")).process_sale(150.0, "1234")
+        ledger.close()  # "Crash": mọi payment đã xác nhận đều đã fsync.
+        with open(os.path.join(directory, Ledger.LOG_FILE), "ab") as log:
+            log.write(b"3 alice -99")  # Record ghi dở lúc crash – phải bị bỏ qua.
+        recovered = BankAccount(1000.0, ledger=Ledger(directory), account_id="alice")
+        print(f"Recovered balance after restart: {recovered.balance}")
+        recovered.ledger.close()
+
+    if "--bench" in sys.argv[1:]:
+        print("\n=== Concurrent checkout (payments/sec by thread count) ===")
+        benchmark_concurrent_payments()
+        print("\n=== Ledger group commit (payments/sec by batch window) ===")
+        benchmark_ledger()
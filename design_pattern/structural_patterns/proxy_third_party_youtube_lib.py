@@ -1,7 +1,22 @@
 # Service Interface (giao diện chung), Service (object gốc), Proxy (đại diện thay thế), Client (người dùng)
 from abc import ABC, abstractmethod
-from typing import List, Dict, Optional
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Event, Lock, Thread, local
+from typing import Any, Awaitable, Callable, Hashable, Iterable, Iterator, List, Dict, Optional, Sequence
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
 import time  # Để minh họa delay của service chậm (network/API).
+import tracemalloc
+import weakref
 
 # TÊN NGUYÊN BẢN: Service Interface – Giao diện chung cho proxy/service (ThirdPartyYouTubeLib).
 # ÁNH XẠ THỰC TẾ: Đây là "YouTubeLib Interface" – định nghĩa methods như API contract, để proxy "giả dạng" service.
@@ -21,12 +36,29 @@ class ThirdPartyYouTubeLib(ABC):
     def download_video(self, id: str) -> str:
         pass
 
+    def get_video_infos(self, ids: Sequence[str]) -> Dict[str, Dict]:
+        # Multi-get: id -> info (theo thứ tự ids, bỏ trùng). Mặc định gọi từng id; service có batch API
+        # thì override để trả cả batch trong 1 round-trip. Batch API có thể bỏ sót id (video đã xoá, bị
+        # chặn...) – id đó vắng mặt trong kết quả, caller không được giả định đủ key.
+        return {id: self.get_video_info(id) for id in dict.fromkeys(ids)}
+
+    # Capability tường minh: service override stream_video thì đặt True. Proxy kiểm tra flag này trước khi
+    # stream (không dùng NotImplementedError làm cờ); False thì proxy quay về download_video (chỉ cache path).
+    supports_streaming = False
+
+    def stream_video(self, id: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        # Nội dung video theo từng chunk (không buffer cả file trong memory). Chỉ gọi khi supports_streaming.
+        raise NotImplementedError(f"{type(self).__name__} does not support streaming")
+
 # TÊN NGUYÊN BẢN: Service – Object gốc chứa business logic (ThirdPartyYouTubeClass).
 # ÁNH XẠ THỰC TẾ: Đây là "YouTube API Service" – logic thực (fetch data chậm từ network).
 # BẢN CHẤT: Service không biết proxy – chỉ làm việc chính; proxy delegate calls đến đây sau khi thêm logic (e.g., cache check).
 
 
 class ThirdPartyYouTubeClass(ThirdPartyYouTubeLib):
+    VIDEO_SIZE = 1024 * 1024  # Bytes mỗi video giả lập.
+    supports_streaming = True
+
     def list_videos(self) -> List[str]:
         time.sleep(1)  # Giả lập delay chậm (network).
         print("Service: Fetching video list from YouTube API...")
@@ -38,64 +70,821 @@ class ThirdPartyYouTubeClass(ThirdPartyYouTubeLib):
         # Giả lập metadata.
         return {"title": f"Video {id}", "duration": "5min"}
 
+    def get_video_infos(self, ids: Sequence[str]) -> Dict[str, Dict]:
+        time.sleep(1.5)  # Batch endpoint: 1 latency cho cả batch.
+        ids = list(dict.fromkeys(ids))
+        print(f"Service: Fetching info for {len(ids)} videos in one batch...")
+        return {id: {"title": f"Video {id}", "duration": "5min"} for id in ids}
+
     def download_video(self, id: str) -> str:
         time.sleep(3)  # Chậm nhất, tốn bandwidth.
         print(f"Service: Downloading video {id}...")
         return f"downloaded_{id}.mp4"  # Giả lập file path.
 
+    def stream_video(self, id: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        time.sleep(3)
+        print(f"Service: Streaming video {id}...")
+        # Giả lập nội dung: deterministic theo id (cùng id → cùng bytes), sinh từng chunk.
+        seed = hashlib.sha256(id.encode()).digest()
+        for offset in range(0, self.VIDEO_SIZE, chunk_size):
+            size = min(chunk_size, self.VIDEO_SIZE - offset)
+            yield (seed * (size // len(seed) + 1))[:size]
+
+# LRUCache: Cache có giới hạn (số entry và/hoặc bytes) + TTL mỗi entry + invalidate từng key.
+# ÁP DỤNG: Cache trong proxy phải bounded – dict không giới hạn sẽ phình theo số key khác nhau (long tail).
+# BẢN CHẤT: OrderedDict giữ thứ tự truy cập (cũ nhất ở đầu) → evict từ đầu khi vượt giới hạn, O(1) mỗi thao tác.
+# Thread-safe: mọi thao tác giữ 1 lock ngắn (không bao giờ giữ lock khi gọi service).
+
+
+def approx_size(value: Any) -> int:
+    # Ước lượng bytes của value (đệ quy qua list/tuple/dict) – đủ dùng để giới hạn max_bytes.
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approx_size(item) for item in value)
+    return size
+
+
+class LRUCache:
+    def __init__(self, max_entries: Optional[int] = 1024, max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None, sizeof: Callable[[Any], int] = approx_size,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries  # None = không giới hạn số entry.
+        self.max_bytes = max_bytes  # None = không giới hạn bytes.
+        self.ttl = ttl  # Giây; None = không hết hạn.
+        self._sizeof = sizeof
+        self._clock = clock
+        # key -> (value, expires_at, size, stored_at); thứ tự = LRU (đầu là ít dùng gần đây nhất).
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = Lock()
+        self.bytes = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        return self.get_with_age(key, default)[0]
+
+    def get_with_age(self, key: Hashable, default: Any = None) -> tuple:
+        # (value, tuổi entry tính bằng giây) – cho stale-while-revalidate; (default, None) nếu miss.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default, None
+            value, expires_at, _size, stored_at = entry
+            now = self._clock()
+            if expires_at is not None and now >= expires_at:
+                self._remove(key)  # Hết TTL – coi như miss.
+                return default, None
+            self._entries.move_to_end(key)
+            return value, now - stored_at
+
+    def put(self, key: Hashable, value: Any, ttl: Optional[float] = None, age: float = 0.0) -> None:
+        # age > 0: value đã cũ sẵn (e.g., nạp từ store bền) – TTL tính từ lúc value được lấy, không phải lúc put.
+        ttl = self.ttl if ttl is None else ttl
+        now = self._clock() - age
+        expires_at = None if ttl is None else now + ttl
+        size = self._sizeof(value) if self.max_bytes is not None else 0  # Tính ngoài lock.
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at, size, now)
+            self.bytes += size
+            self._evict()
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        self.bytes -= self._entries.pop(key)[2]
+
+    def _evict(self) -> None:
+        while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries)
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self.bytes -= self._entries.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def __contains__(self, key: Hashable) -> bool:
+        # Không tính là "truy cập" (không đổi thứ tự LRU), không kiểm TTL.
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_MISSING = object()  # Sentinel: phân biệt "không có trong cache" với value None.
+
+# SingleFlight: Gộp các lần gọi đồng thời cùng key thành 1 lần gọi thật (request coalescing).
+# ÁP DỤNG: 200 thread cùng miss 1 video → chỉ thread đầu tiên (leader) gọi upstream, các thread khác chờ
+# và nhận chung kết quả hoặc chung exception – tránh thundering herd vào service chậm/đắt.
+# BẢN CHẤT: Giống golang.org/x/sync/singleflight – key chỉ "in flight" trong lúc gọi; xong là xoá để lần sau
+# (e.g., sau khi cache hết hạn hoặc lỗi) gọi lại bình thường.
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fn()
+            return call.value
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+# DiskDownloadCache: Cache file video trên đĩa – content-addressed (tên file = sha256 nội dung), giới hạn tổng
+# bytes, evict LRU, index JSON để restart dùng lại file đã tải.
+# ÁP DỤNG: Video quá lớn để giữ trong memory – stream từng chunk vào file tạm (vừa ghi vừa hash), xong mới
+# os.replace thành file đích (atomic: crash giữa chừng không để lại file dở dang mang tên hợp lệ).
+# BẢN CHẤT: 2 lớp ánh xạ: id -> digest -> file. 2 id cùng nội dung dùng chung 1 file; file chỉ bị xoá khi
+# không còn id nào trỏ tới. Lock chỉ giữ khi sửa index – không giữ khi stream (I/O chậm).
+# SỬA LỖI: Dọn rác lúc mở chỉ xoá file do cache tạo ra (tên = 64 hex digest + .mp4, file tạm có PART_PREFIX) –
+# directory có thể dùng chung, file khác của user (e.g., my_holiday.mp4) không bao giờ bị đụng tới.
+
+
+class DiskDownloadCache:
+    INDEX_FILE = "index.json"
+    SUFFIX = ".mp4"
+    PART_PREFIX = "download-"  # File tạm đang tải (PART_PREFIX...PART_SUFFIX) – bị dọn khi mở lại cache.
+    PART_SUFFIX = ".part"
+    BLOB_NAME = re.compile(r"[0-9a-f]{64}")  # Tên file blob (không kể SUFFIX) = sha256 hexdigest.
+
+    def __init__(self, directory: str, max_bytes: int = 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._videos: Dict[str, str] = {}  # id -> digest.
+        # digest -> size; thứ tự = LRU (đầu là ít dùng gần đây nhất).
+        self._blobs: "OrderedDict[str, int]" = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def path_of(self, digest: str) -> str:
+        return os.path.join(self.directory, digest + self.SUFFIX)
+
+    def _load_index(self) -> None:
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE), encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {"videos": {}, "blobs": []}  # Không có/hỏng index: bắt đầu rỗng.
+        # Chỉ giữ entry có file thật với đúng size (file bị xoá tay hoặc ghi dở thì bỏ).
+        for digest, size in index["blobs"]:
+            path = self.path_of(digest)
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                self._blobs[digest] = size
+                self.bytes += size
+        self._videos = {id: digest for id, digest in index["videos"].items() if digest in self._blobs}
+        for name in os.listdir(self.directory):
+            stem = name[:-len(self.SUFFIX)] if name.endswith(self.SUFFIX) else None
+            stale = (name.startswith(self.PART_PREFIX) and name.endswith(self.PART_SUFFIX)) or (
+                stem is not None and self.BLOB_NAME.fullmatch(stem) and stem not in self._blobs)
+            if stale:
+                os.remove(os.path.join(self.directory, name))  # File tạm/blob của cache không có trong index.
+
+    def _save_index_locked(self) -> None:
+        # Ghi file tạm rồi os.replace – index trên đĩa luôn là 1 bản đầy đủ.
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"videos": self._videos, "blobs": list(self._blobs.items())}, f)
+        os.replace(path + ".tmp", path)
+
+    def get(self, id: str) -> Optional[str]:
+        # Path file nếu đã có (đánh dấu vừa dùng), None nếu chưa. Thứ tự LRU lưu xuống đĩa ở lần ghi index sau.
+        with self._lock:
+            digest = self._videos.get(id)
+            if digest is None:
+                return None
+            self._blobs.move_to_end(digest)
+            return self.path_of(digest)
+
+    def put_stream(self, id: str, chunks: Iterable[bytes]) -> str:
+        # Stream chunks vào file tạm, hash trong lúc ghi; memory = 1 chunk, không phụ thuộc kích thước video.
+        digest = hashlib.sha256()
+        size = 0
+        fd, part = tempfile.mkstemp(suffix=self.PART_SUFFIX, prefix=self.PART_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            with self._lock:
+                digest = digest.hexdigest()
+                path = self.path_of(digest)
+                if digest in self._blobs:
+                    os.remove(part)  # Nội dung đã có (id khác) – dùng chung file.
+                    self._blobs.move_to_end(digest)
+                else:
+                    os.replace(part, path)
+                    self._blobs[digest] = size
+                    self.bytes += size
+                previous = self._videos.get(id)
+                self._videos[id] = digest
+                if previous is not None and previous != digest:
+                    self._release_locked(previous)
+                self._evict_locked()
+                self._save_index_locked()
+                return path
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+
+    def invalidate(self, id: str) -> bool:
+        with self._lock:
+            digest = self._videos.pop(id, None)
+            if digest is None:
+                return False
+            self._release_locked(digest)
+            self._save_index_locked()
+            return True
+
+    def clear(self) -> None:
+        with self._lock:
+            for digest in list(self._blobs):
+                self._remove_blob_locked(digest)
+            self._videos.clear()
+            self._save_index_locked()
+
+    def _release_locked(self, digest: str) -> None:
+        # Xoá file khi không còn id nào trỏ tới digest.
+        if digest not in self._videos.values():
+            self._remove_blob_locked(digest)
+
+    def _remove_blob_locked(self, digest: str) -> None:
+        self.bytes -= self._blobs.pop(digest)
+        try:
+            os.remove(self.path_of(digest))
+        except FileNotFoundError:
+            pass
+
+    def _evict_locked(self) -> None:
+        # Evict file ít dùng nhất đến khi dưới max_bytes; luôn giữ file vừa dùng (cuối) dù lớn hơn giới hạn.
+        while len(self._blobs) > 1 and self.bytes > self.max_bytes:
+            digest = next(iter(self._blobs))
+            self._remove_blob_locked(digest)
+            self._videos = {id: d for id, d in self._videos.items() if d != digest}
+            self.evictions += 1
+
+    def __contains__(self, id: str) -> bool:
+        return id in self._videos
+
+    def __len__(self) -> int:
+        return len(self._videos)
+
+# PersistentCacheStore: Lớp bền (sqlite, file local) dưới cache memory của proxy – deploy/restart không
+# phải dội upstream để warm lại list_cache/video_cache.
+# ÁP DỤNG: Write-behind – put chỉ ghi vào dict pending (memory), writer thread gom batch và ghi 1 transaction
+# mỗi flush_interval (hoặc khi đủ max_batch) → hot path không bao giờ chờ đĩa. Load lazy: chỉ đọc đĩa khi
+# cache memory miss (thay vì nạp toàn bộ lúc khởi động); hit không chạm đĩa.
+# BẢN CHẤT: Lưu stored_at theo wall clock (time.time) – monotonic không sống qua restart – để TTL vẫn đúng.
+
+
+class PersistentCacheStore:
+    def __init__(self, path: str, flush_interval: float = 0.2, max_batch: int = 512,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._clock = clock
+        # (namespace, key) -> (value, stored_at), hoặc None = chờ xoá. Ghi trùng key trong 1 batch gộp thành 1.
+        self._pending: Dict[tuple, Optional[tuple]] = {}
+        self._lock = Lock()  # Bảo vệ _pending – chỉ giữ trong thao tác dict.
+        self._db_lock = Lock()  # Bảo vệ connection; thứ tự lock: _db_lock rồi _lock.
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key TEXT NOT NULL, "
+                           "value TEXT NOT NULL, stored_at REAL NOT NULL, PRIMARY KEY (namespace, key))")
+        self._conn.commit()
+        self.batches = 0
+        self.rows_written = 0
+        self._wake = Event()
+        self._closed = False
+        self._writer = Thread(target=self._write_loop, name="cache-writer", daemon=True)
+        self._writer.start()
+
+    def put(self, namespace: str, key: str, value: Any) -> None:
+        # Không I/O, không encode JSON – chỉ ghi dict; writer thread lo phần còn lại.
+        with self._lock:
+            self._pending[(namespace, key)] = (value, self._clock())
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wake.set()
+
+    def invalidate(self, namespace: str, key: str) -> None:
+        with self._lock:
+            self._pending[(namespace, key)] = None
+
+    def load(self, namespace: str, key: str, ttl: Optional[float] = None) -> Optional[tuple]:
+        # (value, age) hoặc None nếu không có / đã quá TTL. Bản pending (chưa flush) được ưu tiên.
+        with self._lock:
+            pending = self._pending.get((namespace, key), _MISSING)
+        if pending is None:
+            return None
+        if pending is not _MISSING:
+            value, stored_at = pending
+        else:
+            with self._db_lock:
+                row = self._conn.execute("SELECT value, stored_at FROM entries WHERE namespace = ? AND key = ?",
+                                         (namespace, key)).fetchone()
+            if row is None:
+                return None
+            value, stored_at = json.loads(row[0]), row[1]
+        age = max(0.0, self._clock() - stored_at)
+        if ttl is not None and age >= ttl:
+            return None
+        return value, age
+
+    def clear(self) -> None:
+        with self._db_lock:
+            with self._lock:
+                self._pending.clear()
+            with self._conn:
+                self._conn.execute("DELETE FROM entries")
+
+    def flush(self) -> None:
+        # Ghi toàn bộ pending trong 1 transaction. Giữ _db_lock suốt batch – clear() không xen giữa được.
+        with self._db_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            upserts = [(namespace, key, json.dumps(row[0]), row[1])
+                       for (namespace, key), row in batch.items() if row is not None]
+            deletes = [key for key, row in batch.items() if row is None]
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", upserts)
+                self._conn.executemany("DELETE FROM entries WHERE namespace = ? AND key = ?", deletes)
+            self.batches += 1
+            self.rows_written += len(batch)
+
+    def _write_loop(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as exc:
+                print(f"PersistentCacheStore: flush failed: {exc!r}")
+
+    def close(self) -> None:
+        # Flush nốt pending rồi đóng – gọi khi shutdown để không mất write cuối.
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+        self._conn.close()
+
+# ProxyMetrics: Số liệu để biết proxy có "đáng tiền" không – thay cho việc đọc print "Cache hit"/"Cache miss".
+# ÁP DỤNG: Đếm hit/miss/stale/persisted theo method, histogram latency upstream (bucket log2 theo µs),
+# gauge số lời gọi upstream đang chạy (in_flight); snapshot() trả dict (đẩy sang Prometheus/log).
+# BẢN CHẤT: Hot path không lấy lock – mỗi thread ghi vào shard riêng (thread-local), snapshot() cộng
+# các shard lại → 1 counter chỉ tốn vài trăm ns. metrics=False dùng _NoMetrics (Null Object) – proxy không
+# phải rẽ nhánh "if metrics" ở mỗi chỗ đo.
+# SỬA LỖI: Shard không sống mãi – thread chết (e.g., thread refresh SWR, mỗi lần refresh 1 thread) thì
+# weakref.finalize trên object thread-local gộp shard vào tổng "retired" rồi bỏ shard → số shard = số thread
+# đang sống, không phải số thread từng gặp.
+# ÁP DỤNG: call() chỉ ghi latency thô (append int ns vào array) – tính bucket, cộng calls/seconds dồn vào lúc
+# fold (mỗi FOLD_EVERY lời gọi) hoặc snapshot(); không try/finally, không lookup lồng nhau trên hot path.
+
+_perf_counter_ns = time.perf_counter_ns
+
+
+def _latency_buckets(samples: Iterable[int], buckets: List[int]) -> None:
+    # Cộng dồn các latency (ns) vào histogram log2 theo µs – map/Counter chạy ở tốc độ C, không loop Python
+    # theo từng sample.
+    last = ProxyMetrics.BUCKETS - 1
+    for bucket, n in Counter(map(int.bit_length, map((1000).__rfloordiv__, samples))).items():
+        buckets[min(bucket, last)] += n
+
+
+class _UpstreamStats:
+    __slots__ = ("calls", "errors", "in_flight", "seconds", "buckets", "samples")
+
+    def __init__(self):
+        # calls/seconds/buckets chỉ gồm các lời gọi đã fold; samples = latency thô chưa fold.
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.seconds = 0.0
+        self.buckets = [0] * ProxyMetrics.BUCKETS  # buckets[i]: latency < 2**i µs (i=0: < 1µs).
+        self.samples = array("q")  # Latency thô (ns).
+
+    def fold(self) -> None:
+        # Chỉ thread chủ gọi (hoặc sau khi thread chết). Đổi array mới TRƯỚC khi cộng: snapshot chen giữa chỉ
+        # có thể đếm thiếu tạm thời, không bao giờ đếm 2 lần.
+        samples, self.samples = self.samples, array("q")
+        _latency_buckets(samples, self.buckets)
+        self.seconds += sum(samples) / 1e9
+        self.calls += len(samples)
+
+
+class _ShardOwner:
+    # Chỉ sống trong thread-local của 1 thread – bị huỷ khi thread kết thúc (mốc để gộp shard).
+    __slots__ = ("__weakref__",)
+
+
+class ProxyMetrics:
+    BUCKETS = 32  # Bucket cuối gom mọi latency >= 2**30 µs (~18 phút).
+    FOLD_EVERY = 1024  # Số latency thô tối đa giữ mỗi (thread, method) trước khi fold vào histogram.
+
+    def __init__(self):
+        self._local = local()
+        # id(shard) -> (counts, upstream) của từng thread đang sống – chỉ thread chủ ghi vào shard.
+        self._shards: Dict[int, tuple] = {}
+        self._retired: tuple = ({}, {})  # Tổng của các thread đã kết thúc.
+        self._lock = Lock()  # Giữ khi thêm/gộp shard và khi snapshot – không bao giờ trên hot path.
+
+    def _shard(self) -> tuple:
+        # counts: (method, event) -> count; upstream: method -> _UpstreamStats.
+        shard = self._local.counts, self._local.upstream = {}, {}
+        owner = self._local.owner = _ShardOwner()
+        with self._lock:
+            self._shards[id(shard)] = shard
+        # weakref tới metrics: finalizer không giữ proxy sống theo thread (e.g., thread của pool dài hạn).
+        weakref.finalize(owner, ProxyMetrics._retire, weakref.ref(self), shard)
+        return shard
+
+    @staticmethod
+    def _retire(metrics_ref: "weakref.ref[ProxyMetrics]", shard: tuple) -> None:
+        metrics = metrics_ref()
+        if metrics is None:
+            return
+        counts, upstream = shard
+        for stats in upstream.values():
+            stats.fold()  # Thread chủ đã kết thúc – không còn ai append.
+        retired_counts, retired_upstream = metrics._retired
+        with metrics._lock:
+            del metrics._shards[id(shard)]
+            for key, n in counts.items():
+                retired_counts[key] = retired_counts.get(key, 0) + n
+            for method, stats in upstream.items():
+                total = retired_upstream.get(method)
+                if total is None:
+                    total = retired_upstream[method] = _UpstreamStats()
+                total.calls += stats.calls
+                total.errors += stats.errors
+                total.in_flight += stats.in_flight
+                total.seconds += stats.seconds
+                total.buckets = [a + b for a, b in zip(total.buckets, stats.buckets)]
+
+    def count(self, method: str, event: str, n: int = 1) -> None:
+        try:
+            counts = self._local.counts
+        except AttributeError:
+            counts = self._shard()[0]
+        key = (method, event)
+        counts[key] = counts.get(key, 0) + n
+
+    def _upstream_stats(self, method: str) -> _UpstreamStats:
+        # Đường chậm của call(): lần đầu thread gặp metrics/method này.
+        try:
+            upstream = self._local.upstream
+        except AttributeError:
+            upstream = self._shard()[1]
+        stats = upstream.get(method)
+        if stats is None:
+            stats = upstream[method] = _UpstreamStats()
+        return stats
+
+    def call(self, method: str, fn: Callable[[], Any]) -> Any:
+        # Gọi upstream có đo: gauge in_flight quanh lời gọi, latency thô vào samples (kể cả khi lỗi).
+        try:
+            stats = self._local.upstream[method]
+        except (AttributeError, KeyError):
+            stats = self._upstream_stats(method)
+        stats.in_flight += 1
+        start = _perf_counter_ns()
+        try:
+            value = fn()
+        except BaseException:
+            stats.samples.append(_perf_counter_ns() - start)
+            stats.in_flight -= 1
+            stats.errors += 1
+            raise
+        samples = stats.samples
+        samples.append(_perf_counter_ns() - start)
+        stats.in_flight -= 1
+        if len(samples) >= self.FOLD_EVERY:
+            stats.fold()
+        return value
+
+    def snapshot(self) -> Dict[str, Any]:
+        # Đọc shard của thread khác không cần lock của thread đó (GIL) – số liệu có thể lệch 1 vài lời gọi đang
+        # chạy. Giữ _lock suốt lúc cộng: shard đang được gộp vào _retired không bị đếm 2 lần.
+        methods: Dict[str, Dict[str, int]] = {}
+        upstream: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            for counts, upstream_stats in [self._retired, *self._shards.values()]:
+                for (method, event), n in list(counts.items()):
+                    events = methods.setdefault(method, {})
+                    events[event] = events.get(event, 0) + n
+                for method, stats in list(upstream_stats.items()):
+                    total = upstream.setdefault(method, {"calls": 0, "errors": 0, "in_flight": 0, "seconds": 0.0,
+                                                         "buckets": [0] * self.BUCKETS})
+                    # Phần đã fold trước, samples sau (xem _UpstreamStats.fold) – copy samples vì thread chủ
+                    # vẫn đang append.
+                    total["calls"] += stats.calls
+                    total["errors"] += stats.errors
+                    total["in_flight"] += stats.in_flight
+                    total["seconds"] += stats.seconds
+                    total["buckets"] = [a + b for a, b in zip(total["buckets"], stats.buckets)]
+                    samples = stats.samples[:]
+                    total["calls"] += len(samples)
+                    total["seconds"] += sum(samples) / 1e9
+                    _latency_buckets(samples, total["buckets"])
+        for total in upstream.values():
+            # Chỉ bucket khác 0, key = cận trên (µs): {"<1024": 3} nghĩa là 3 lời gọi trong [512, 1024) µs.
+            total["latency_us"] = {f"<{2 ** i}": n for i, n in enumerate(total.pop("buckets")) if n}
+        return {"methods": methods, "upstream": upstream}
+
+
+class _NoMetrics:
+    # Null Object: cùng interface với ProxyMetrics nhưng không đo gì (metrics=False).
+    def count(self, method: str, event: str, n: int = 1) -> None:
+        pass
+
+    def call(self, method: str, fn: Callable[[], Any]) -> Any:
+        return fn()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"methods": {}, "upstream": {}}
+
 # TÊN NGUYÊN BẢN: Proxy – Đại diện thay thế, wrap service và thêm logic (CachedYouTubeClass).
 # ÁNH XẠ THỰC TẾ: Đây là "Cached YouTube Proxy" – wrap API service để thêm caching, kiểm soát access (cache hit/miss).
 # BẢN CHẤT: Proxy giữ wrappee ref (service), delegate calls sau "kiểm soát" (e.g., check cache trước fetch) – mở rộng không sửa service.
+# SỬA LỖI: Bỏ flag need_reset (invalidate tất cả, lại bị reset sau lần refetch đầu nên key khác vẫn stale) –
+# thay bằng LRUCache bounded + TTL cho cả 3 method và invalidate(id) theo từng key.
+# SỬA LỖI: download_video chỉ cache path giả của service, không hề có file – truyền disk_cache để tải thật
+# (stream_video) vào DiskDownloadCache.
+# ÁP DỤNG: Stale-while-revalidate cho list (list_soft_ttl + list_hard_ttl): quá soft TTL vẫn trả list cũ ngay
+# và refresh nền; chỉ quá hard TTL (hoặc chưa có) mới chặn caller chờ upstream.
+# ÁP DỤNG: store=PersistentCacheStore – list/video info miss memory thì thử store trước khi gọi upstream,
+# value mới fetch được ghi write-behind xuống store.
+# ÁP DỤNG: stats() – counters theo method, evictions theo cache, latency upstream (ProxyMetrics).
 
 
 class CachedYouTubeClass(ThirdPartyYouTubeLib):
-    def __init__(self, service: ThirdPartyYouTubeLib):
+    LIST_KEY = "list"  # list_videos không có tham số – 1 key duy nhất.
+
+    def __init__(self, service: ThirdPartyYouTubeLib, max_entries: Optional[int] = 1024,
+                 max_bytes: Optional[int] = None, ttl: Optional[float] = None, verbose: bool = True,
+                 disk_cache: Optional[DiskDownloadCache] = None,
+                 list_soft_ttl: Optional[float] = None, list_hard_ttl: Optional[float] = None,
+                 store: Optional[PersistentCacheStore] = None, metrics: bool = True):
         # Wrappee ref – "bọc" service, quản lý lifecycle (lazy nếu cần).
         self.service = service
-        self.list_cache: Optional[List[str]] = None  # Cache cho list (global).
-        self.video_cache: Dict[str, Dict] = {}  # Cache per ID.
-        # Flag invalidate cache (e.g., nếu data expired).
-        self.need_reset = False
+        # Cache cho list (global); có soft TTL thì entry sống đến hard TTL.
+        self.list_cache = LRUCache(max_entries=1, ttl=ttl if list_hard_ttl is None else list_hard_ttl)
+        self.list_soft_ttl = list_soft_ttl  # None = tắt stale-while-revalidate.
+        self.video_cache = LRUCache(max_entries, max_bytes, ttl)  # Cache per ID.
+        self.download_cache = LRUCache(max_entries, max_bytes, ttl)  # Path file đã download, per ID.
+        self.disk_cache = disk_cache  # None: chỉ cache path do service.download_video trả về.
+        self.store = store  # None: cache chỉ nằm trong memory.
+        # Cache nào được lưu bền -> namespace trong store (path download không lưu: disk_cache đã có index riêng).
+        self._namespaces = {} if store is None else {id(self.list_cache): "list", id(self.video_cache): "video"}
+        self.verbose = verbose  # False: không print hit/miss (benchmark/production).
+        self.metrics = ProxyMetrics() if metrics else _NoMetrics()
+        self._flight = SingleFlight()  # Gộp các miss đồng thời cùng key.
+        self._refreshing: set = set()  # Key đang refresh nền – tối đa 1 thread mỗi key.
+        self._refresh_lock = Lock()
 
-    def list_videos(self) -> List[str]:
+    def _log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
+
+    def _cached(self, cache: LRUCache, key: Hashable, fetch: Callable[[], Any], method: str,
+                hit_message: str, miss_message: str) -> Any:
         # Thêm caching: Check cache trước delegate.
-        if self.list_cache is None or self.need_reset:
-            print("Proxy: Cache miss, fetching from service...")
-            # Delegate đến service sau logic.
-            self.list_cache = self.service.list_videos()
-            self.need_reset = False
-        else:
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
             # Bỏ qua service – kiểm soát access.
-            print("Proxy: Cache hit, returning from cache!")
-        return self.list_cache
+            self.metrics.count(method, "hit")
+            self._log(hit_message)
+            return value
+        self.metrics.count(method, "miss")
+        self._log(miss_message)
+
+        def fetch_and_store() -> Any:
+            # Leader check lại cache: leader trước có thể vừa xong giữa lúc ta miss và lúc vào flight.
+            value = cache.get(key, _MISSING)
+            if value is _MISSING:
+                value = self._load_persisted(cache, key, method)
+            if value is _MISSING:
+                # Delegate đến service sau logic.
+                value = self.metrics.call(method, fetch)
+                cache.put(key, value)
+                self._persist(cache, key, value)
+            return value
+        # Chỉ 1 lần gọi upstream cho mỗi key đang in flight, kể cả khi 200 thread cùng miss.
+        return self._flight.do((id(cache), key), fetch_and_store)
+
+    def _load_persisted(self, cache: LRUCache, key: Hashable, method: str) -> Any:
+        # Lazy load: chỉ chạy trên đường miss; nạp vào cache memory với tuổi gốc để TTL không bị reset.
+        namespace = self._namespaces.get(id(cache))
+        if namespace is None:
+            return _MISSING
+        found = self.store.load(namespace, key, cache.ttl)
+        if found is None:
+            return _MISSING
+        value, age = found
+        cache.put(key, value, age=age)
+        self.metrics.count(method, "persisted")
+        self._log(f"Proxy: Loaded {key} from persistent cache ({age:.1f}s old)")
+        return value
+
+    def _persist(self, cache: LRUCache, key: Hashable, value: Any) -> None:
+        namespace = self._namespaces.get(id(cache))
+        if namespace is not None:
+            self.store.put(namespace, key, value)
+
+    def _cached_swr(self, cache: LRUCache, key: Hashable, fetch: Callable[[], Any], method: str,
+                    soft_ttl: float, hit_message: str, miss_message: str) -> Any:
+        value, age = cache.get_with_age(key, _MISSING)
+        if value is _MISSING:
+            return self._cached(cache, key, fetch, method, hit_message, miss_message)  # Quá hard TTL: chặn.
+        if age >= soft_ttl:
+            self.metrics.count(method, "stale")
+            self._log(f"Proxy: Serving stale {key} ({age:.1f}s old), refreshing in background...")
+            self._refresh_in_background(cache, key, fetch, method)
+        else:
+            self.metrics.count(method, "hit")
+            self._log(hit_message)
+        return value
+
+    def _refresh_in_background(self, cache: LRUCache, key: Hashable, fetch: Callable[[], Any],
+                               method: str) -> None:
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh() -> None:
+            def fetch_and_store() -> Any:
+                value = self.metrics.call(method, fetch)
+                cache.put(key, value)
+                self._persist(cache, key, value)
+                return value
+            try:
+                # Cùng flight key với miss chặn – caller quá hard TTL lúc này dùng chung lời gọi refresh.
+                self._flight.do((id(cache), key), fetch_and_store)
+            except Exception as exc:
+                # Lỗi refresh: tiếp tục trả bản stale đến hard TTL; lần stale sau thử lại.
+                self._log(f"Proxy: Background refresh of {key} failed: {exc!r}")
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(key)
+        Thread(target=refresh, daemon=True).start()
+
+    def list_videos(self) -> List[str]:
+        if self.list_soft_ttl is not None:
+            return self._cached_swr(self.list_cache, self.LIST_KEY, self.service.list_videos, "list_videos",
+                                    self.list_soft_ttl, "Proxy: Cache hit, returning from cache!",
+                                    "Proxy: Cache miss, fetching from service...")
+        return self._cached(self.list_cache, self.LIST_KEY, self.service.list_videos, "list_videos",
+                            "Proxy: Cache hit, returning from cache!",
+                            "Proxy: Cache miss, fetching from service...")
 
     def get_video_info(self, id: str) -> Dict:
         # Caching per ID – tương tự list.
-        if id not in self.video_cache or self.need_reset:
-            print(f"Proxy: Cache miss for {id}, fetching...")
-            self.video_cache[id] = self.service.get_video_info(id)
-            self.need_reset = False
-        else:
-            print(f"Proxy: Cache hit for {id}!")
-        return self.video_cache[id]
+        return self._cached(self.video_cache, id, lambda: self.service.get_video_info(id), "get_video_info",
+                            f"Proxy: Cache hit for {id}!",
+                            f"Proxy: Cache miss for {id}, fetching...")
+
+    def get_video_infos(self, ids: Sequence[str]) -> Dict[str, Dict]:
+        # Hit trả từ cache; chỉ các id miss được gửi upstream trong 1 lần gọi batch.
+        ids = list(dict.fromkeys(ids))
+        infos = {id: self.video_cache.get(id, _MISSING) for id in ids}
+        misses = [id for id, info in infos.items() if info is _MISSING]
+        self.metrics.count("get_video_infos", "hit", len(ids) - len(misses))
+        self.metrics.count("get_video_infos", "miss", len(misses))
+        if misses and self.store is not None:
+            for id in misses:
+                infos[id] = self._load_persisted(self.video_cache, id, "get_video_infos")
+            misses = [id for id, info in infos.items() if info is _MISSING]
+        if len(misses) < len(ids):
+            self._log(f"Proxy: Cache hit for {len(ids) - len(misses)} of {len(ids)} videos!")
+        if misses:
+            self._log(f"Proxy: Cache miss for {len(misses)} videos, fetching one batch...")
+            fetched = self.metrics.call("get_video_infos", lambda: self.service.get_video_infos(misses))
+            for id in misses:
+                info = fetched.get(id, _MISSING)
+                if info is _MISSING:
+                    del infos[id]  # Upstream bỏ sót id: không cache, không làm hỏng cả trang.
+                    continue
+                infos[id] = info
+                self.video_cache.put(id, info)
+                self._persist(self.video_cache, id, info)
+            if len(infos) < len(ids):
+                self.metrics.count("get_video_infos", "missing", len(ids) - len(infos))
+                self._log(f"Proxy: Upstream returned no info for {len(ids) - len(infos)} videos, skipped")
+        return infos
 
     def download_video(self, id: str) -> str:
-        # Thêm check "download exists" (giả lập caching file).
-        if self.need_reset:
-            print(f"Proxy: Cache invalid, re-downloading {id}...")
-            return self.service.download_video(id)
+        if self.disk_cache is not None and self.service.supports_streaming:
+            return self._download_to_disk(id)
+        # Cache path file đã download – delegate chỉ nếu miss (cả khi có disk_cache nhưng service không stream).
+        return self._cached(self.download_cache, id, lambda: self.service.download_video(id), "download_video",
+                            f"Proxy: Using cached download for {id}!",
+                            f"Proxy: Cache miss, downloading {id}...")
+
+    def _download_to_disk(self, id: str) -> str:
+        path = self.disk_cache.get(id)
+        if path is not None:
+            self.metrics.count("download_video", "hit")
+            self._log(f"Proxy: Using cached download for {id}!")
+            return path
+        self.metrics.count("download_video", "miss")
+        self._log(f"Proxy: Cache miss, downloading {id} to disk...")
+
+        def fetch_and_store() -> str:
+            path = self.disk_cache.get(id)
+            if path is None:
+                path = self.metrics.call("download_video",
+                                         lambda: self.disk_cache.put_stream(id, self.service.stream_video(id)))
+            return path
+        return self._flight.do(("disk", id), fetch_and_store)
+
+    def stats(self) -> Dict[str, Any]:
+        # Snapshot metrics + evictions của từng cache (LRU evict khi vượt max_entries/max_bytes).
+        snapshot = self.metrics.snapshot()
+        snapshot["evictions"] = {"list_cache": self.list_cache.evictions, "video_cache": self.video_cache.evictions,
+                                 "download_cache": self.download_cache.evictions}
+        if self.disk_cache is not None:
+            snapshot["evictions"]["disk_cache"] = self.disk_cache.evictions
+        return snapshot
+
+    def invalidate(self, id: Optional[str] = None) -> None:
+        # Invalidate 1 video (info + download) hoặc toàn bộ (id=None) – e.g., khi nhận webhook "video updated".
+        if id is None:
+            self.list_cache.clear()
+            self.video_cache.clear()
+            self.download_cache.clear()
+            if self.disk_cache is not None:
+                self.disk_cache.clear()
+            if self.store is not None:
+                self.store.clear()
         else:
-            print(f"Proxy: Using cached download for {id}!")
-            return f"cached_{id}.mp4"  # Từ cache – delegate chỉ nếu miss.
+            self.video_cache.invalidate(id)
+            self.download_cache.invalidate(id)
+            if self.disk_cache is not None:
+                self.disk_cache.invalidate(id)
+            if self.store is not None:
+                self.store.invalidate("video", id)
 
 # TÊN NGUYÊN BẢN: Client – Người dùng cuối, dùng qua interface (YouTubeManager).
 # ÁNH XẠ THỰC TẾ: Đây là "YouTube App Manager" – code app (GUI/render) gọi methods qua interface.
 # BẢN CHẤT: Client pass proxy như service thật – transparent, không thay code khi swap (real → proxy).
+# ÁP DỤNG: prefetch=N – sau khi render list, warm get_video_info cho N video đầu trên thread pool nền
+# (tối đa max_concurrency lời gọi upstream cùng lúc) → user click video là cache hit của proxy.
 
 
 class YouTubeManager:
-    def __init__(self, service: ThirdPartyYouTubeLib):
+    def __init__(self, service: ThirdPartyYouTubeLib, prefetch: int = 0, max_concurrency: int = 4):
         self.service = service  # Proxy hoặc real – không phân biệt!
+        self.prefetch = prefetch  # 0 = tắt prefetch.
+        self.max_concurrency = max_concurrency
+        self._executor: Optional[ThreadPoolExecutor] = None  # Tạo lazy ở lần prefetch đầu.
+        self._prefetches: List[Future] = []
+        self._lock = Lock()
 
     def render_video_page(self, id: str):
         info = self.service.get_video_info(id)  # Proxy cache → nhanh lần 2.
@@ -104,12 +893,356 @@ class YouTubeManager:
     def render_list_panel(self):
         videos = self.service.list_videos()  # Proxy cache → chỉ fetch 1 lần.
         print(f"Manager: Rendering list: {videos}")
+        if self.prefetch > 0:
+            self._start_prefetch(videos[:self.prefetch])
+
+    def _start_prefetch(self, ids: Sequence[str]) -> None:
+        # List mới thay list cũ: huỷ prefetch cũ chưa chạy trước khi xếp hàng prefetch mới.
+        with self._lock:
+            self._cancel_locked()
+            if self._executor is None:
+                # Pool bounded = giới hạn số lời gọi upstream đồng thời; phần còn lại xếp hàng.
+                self._executor = ThreadPoolExecutor(self.max_concurrency, thread_name_prefix="prefetch")
+            self._prefetches = [self._executor.submit(self.service.get_video_info, id) for id in ids]
+
+    def cancel_prefetch(self) -> int:
+        # Huỷ các prefetch chưa bắt đầu (lời gọi đang chạy thì để xong – kết quả vẫn vào cache).
+        with self._lock:
+            return self._cancel_locked()
+
+    def _cancel_locked(self) -> int:
+        cancelled = sum(future.cancel() for future in self._prefetches)
+        self._prefetches = []
+        return cancelled
+
+    def wait_for_prefetch(self, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            pending = list(self._prefetches)
+        wait(pending, timeout)  # Lỗi prefetch bị bỏ qua – lần click thật sẽ gọi lại.
+
+    def close(self) -> None:
+        with self._lock:
+            self._cancel_locked()
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def render_related_videos(self, ids: Sequence[str]):
+        # Multi-get: 1 lần gọi cho cả danh sách thay vì N lần get_video_info.
+        infos = self.service.get_video_infos(ids)
+        print(f"Manager: Rendering {len(infos)} related videos")
 
     def react_on_user_input(self):
         self.render_video_page("vid123")
         self.render_list_panel()
 
 
+# ASYNC VARIANT: Cùng bộ 4 vai trò (Interface, Service, Proxy, Client) cho frontend asyncio.
+# ÁNH XẠ THỰC TẾ: time.sleep chặn cả event loop; asyncio.sleep (I/O thật: aiohttp) nhường loop cho request khác.
+# BẢN CHẤT: Proxy async dùng lại LRUCache; coalescing bằng asyncio.Task – miss cùng key dùng chung 1 task
+# (await qua asyncio.shield: 1 caller bị cancel không huỷ fetch của các caller còn lại).
+
+
+class AsyncThirdPartyYouTubeLib(ABC):
+    @abstractmethod
+    async def list_videos(self) -> List[str]:
+        pass
+
+    @abstractmethod
+    async def get_video_info(self, id: str) -> Dict:
+        pass
+
+    @abstractmethod
+    async def download_video(self, id: str) -> str:
+        pass
+
+    async def get_video_infos(self, ids: Sequence[str]) -> Dict[str, Dict]:
+        # Mặc định: gather từng id (đồng thời); service có batch API thì override.
+        ids = list(dict.fromkeys(ids))
+        return dict(zip(ids, await asyncio.gather(*(self.get_video_info(id) for id in ids))))
+
+
+class AsyncThirdPartyYouTubeClass(AsyncThirdPartyYouTubeLib):
+    async def list_videos(self) -> List[str]:
+        await asyncio.sleep(1)  # Giả lập network – không chặn event loop.
+        print("Service (async): Fetching video list from YouTube API...")
+        return ["Video1", "Video2", "Video3"]
+
+    async def get_video_info(self, id: str) -> Dict:
+        await asyncio.sleep(1.5)
+        print(f"Service (async): Fetching info for video {id}...")
+        return {"title": f"Video {id}", "duration": "5min"}
+
+    async def get_video_infos(self, ids: Sequence[str]) -> Dict[str, Dict]:
+        await asyncio.sleep(1.5)  # 1 latency cho cả batch.
+        ids = list(dict.fromkeys(ids))
+        print(f"Service (async): Fetching info for {len(ids)} videos in one batch...")
+        return {id: {"title": f"Video {id}", "duration": "5min"} for id in ids}
+
+    async def download_video(self, id: str) -> str:
+        await asyncio.sleep(3)
+        print(f"Service (async): Downloading video {id}...")
+        return f"downloaded_{id}.mp4"
+
+
+class AsyncCachedYouTubeClass(AsyncThirdPartyYouTubeLib):
+    LIST_KEY = CachedYouTubeClass.LIST_KEY
+
+    def __init__(self, service: AsyncThirdPartyYouTubeLib, max_entries: Optional[int] = 1024,
+                 max_bytes: Optional[int] = None, ttl: Optional[float] = None, verbose: bool = True):
+        self.service = service
+        self.list_cache = LRUCache(max_entries=1, ttl=ttl)
+        self.video_cache = LRUCache(max_entries, max_bytes, ttl)
+        self.download_cache = LRUCache(max_entries, max_bytes, ttl)
+        self.verbose = verbose
+        # Miss đang in flight: (cache, key) -> Task. Chỉ chạm từ event loop thread – không cần lock.
+        self._in_flight: Dict[Hashable, "asyncio.Task[Any]"] = {}
+
+    def _log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
+
+    async def _cached(self, cache: LRUCache, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                      hit_message: str, miss_message: str) -> Any:
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            self._log(hit_message)
+            return value
+        flight_key = (id(cache), key)
+        task = self._in_flight.get(flight_key)
+        if task is None:
+            self._log(miss_message)
+            task = asyncio.ensure_future(self._fetch_and_store(cache, key, fetch))
+            self._in_flight[flight_key] = task
+            task.add_done_callback(lambda _task: self._in_flight.pop(flight_key, None))
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def _fetch_and_store(cache: LRUCache, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = await fetch()
+        cache.put(key, value)
+        return value
+
+    async def list_videos(self) -> List[str]:
+        return await self._cached(self.list_cache, self.LIST_KEY, self.service.list_videos,
+                                  "Proxy (async): Cache hit, returning from cache!",
+                                  "Proxy (async): Cache miss, fetching from service...")
+
+    async def get_video_info(self, id: str) -> Dict:
+        return await self._cached(self.video_cache, id, lambda: self.service.get_video_info(id),
+                                  f"Proxy (async): Cache hit for {id}!",
+                                  f"Proxy (async): Cache miss for {id}, fetching...")
+
+    async def get_video_infos(self, ids: Sequence[str]) -> Dict[str, Dict]:
+        ids = list(dict.fromkeys(ids))
+        infos = {id: self.video_cache.get(id, _MISSING) for id in ids}
+        misses = [id for id, info in infos.items() if info is _MISSING]
+        if misses:
+            self._log(f"Proxy (async): Cache miss for {len(misses)} videos, fetching one batch...")
+            fetched = await self.service.get_video_infos(misses)
+            for id in misses:
+                info = fetched.get(id, _MISSING)
+                if info is _MISSING:
+                    del infos[id]  # Upstream bỏ sót id: không cache, không làm hỏng cả trang.
+                    continue
+                infos[id] = info
+                self.video_cache.put(id, info)
+            if len(infos) < len(ids):
+                self._log(f"Proxy (async): Upstream returned no info for {len(ids) - len(infos)} videos, skipped")
+        return infos
+
+    async def download_video(self, id: str) -> str:
+        return await self._cached(self.download_cache, id, lambda: self.service.download_video(id),
+                                  f"Proxy (async): Using cached download for {id}!",
+                                  f"Proxy (async): Cache miss, downloading {id}...")
+
+    def invalidate(self, id: Optional[str] = None) -> None:
+        if id is None:
+            self.list_cache.clear()
+            self.video_cache.clear()
+            self.download_cache.clear()
+        else:
+            self.video_cache.invalidate(id)
+            self.download_cache.invalidate(id)
+
+
+class AsyncYouTubeManager:
+    def __init__(self, service: AsyncThirdPartyYouTubeLib):
+        self.service = service  # Proxy hoặc real – không phân biệt!
+
+    async def render_video_page(self, id: str):
+        info = await self.service.get_video_info(id)
+        print(f"Manager (async): Rendering page for {info['title']}")
+
+    async def render_list_panel(self):
+        videos = await self.service.list_videos()
+        print(f"Manager (async): Rendering list: {videos}")
+
+    async def render_related_videos(self, ids: Sequence[str]):
+        # Trang cần N video info: multi-get (batch hoặc gather đồng thời) → ≈ 1 latency upstream, không phải N.
+        infos = await self.service.get_video_infos(ids)
+        print(f"Manager (async): Rendering {len(infos)} related videos")
+
+    async def react_on_user_input(self):
+        await asyncio.gather(self.render_video_page("vid123"), self.render_list_panel())
+
+
+async def async_demo() -> None:
+    proxy = AsyncCachedYouTubeClass(AsyncThirdPartyYouTubeClass(), verbose=False)
+    manager = AsyncYouTubeManager(proxy)
+    ids = [f"vid{i}" for i in range(20)]
+    for attempt in ("cold", "warm"):
+        start = time.perf_counter()
+        await manager.render_related_videos(ids)
+        print(f"Async page with {len(ids)} video infos ({attempt} cache): {time.perf_counter() - start:.2f}s")
+
+# Stress test: 200 thread cùng miss 1 video trên stand-in có sleep thật – chỉ được 1 lần gọi upstream,
+# mọi thread nhận cùng kết quả; nếu upstream lỗi, mọi thread nhận exception và lần gọi sau thử lại.
+
+
+class CountingYouTubeClass(ThirdPartyYouTubeClass):
+    def __init__(self, fail: bool = False):
+        self.calls = 0
+        self.fail = fail
+        self._lock = Lock()
+
+    def get_video_info(self, id: str) -> Dict:
+        with self._lock:
+            self.calls += 1
+        info = super().get_video_info(id)
+        if self.fail:
+            raise ConnectionError(f"upstream failed for {id}")
+        return info
+
+
+def stress_test_single_flight(threads: int = 200) -> None:
+    for fail in (False, True):
+        service = CountingYouTubeClass(fail)
+        proxy = CachedYouTubeClass(service, verbose=False)
+        results: List[Any] = [None] * threads
+        start_gate = Event()
+
+        def worker(i: int) -> None:
+            start_gate.wait()
+            try:
+                results[i] = proxy.get_video_info("vid123")
+            except ConnectionError as exc:
+                results[i] = exc
+
+        workers = [Thread(target=worker, args=(i,)) for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        start = time.perf_counter()
+        start_gate.set()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        assert service.calls == 1, f"expected 1 upstream call, got {service.calls}"
+        assert all(result is results[0] for result in results)
+        if fail:
+            assert isinstance(results[0], ConnectionError)
+            assert "vid123" not in proxy.video_cache  # Lỗi không bị cache – lần sau gọi lại.
+        outcome = "exception" if fail else "result"
+        print(f"Single-flight: {threads} concurrent misses -> {service.calls} upstream call, "
+              f"all got the same {outcome} in {elapsed:.2f}s")
+
+# Benchmark: Memory của cache proxy dưới phân phối key long-tail (Pareto) – LRUCache bounded giữ memory
+# phẳng, còn dict không giới hạn (cách cũ) tăng theo số key khác nhau.
+
+
+class InstantYouTubeClass(ThirdPartyYouTubeLib):
+    # Stand-in không sleep/print – đo chi phí của proxy, không đo network giả lập.
+    def list_videos(self) -> List[str]:
+        return ["Video1", "Video2", "Video3"]
+
+    def get_video_info(self, id: str) -> Dict:
+        return {"title": f"Video {id}", "duration": "5min"}
+
+    def download_video(self, id: str) -> str:
+        return f"downloaded_{id}.mp4"
+
+
+def benchmark_cache_memory(requests: int = 300_000, max_entries: int = 5_000, seed: int = 42) -> None:
+    for label, proxy in (("bounded LRUCache", CachedYouTubeClass(InstantYouTubeClass(), max_entries, verbose=False)),
+                         ("unbounded", CachedYouTubeClass(InstantYouTubeClass(), None, verbose=False))):
+        rng = random.Random(seed)
+        tracemalloc.start()
+        samples = []
+        for i in range(1, requests + 1):
+            proxy.get_video_info(f"vid{int(rng.paretovariate(0.5) * 100)}")
+            if i % (requests // 5) == 0:
+                samples.append(f"{tracemalloc.get_traced_memory()[0] / 2**20:.1f}")
+        tracemalloc.stop()
+        print(f"{label}: memory (MiB) after each {requests // 5:,} requests: {', '.join(samples)} "
+              f"({len(proxy.video_cache):,} entries, {proxy.video_cache.evictions:,} evictions)")
+
+
+class SlowListYouTubeClass(InstantYouTubeClass):
+    # Stand-in chỉ list chậm (50ms) – đo latency list_videos khi cache hết hạn định kỳ.
+    def list_videos(self) -> List[str]:
+        time.sleep(0.05)
+        return ["Video1", "Video2", "Video3"]
+
+
+def benchmark_list_latency(duration: float = 2.0, ttl: float = 0.1) -> None:
+    # p50/p99 latency list_videos: TTL thường (hết hạn là chặn) vs stale-while-revalidate (soft = ttl).
+    for label, proxy in (("ttl only", CachedYouTubeClass(SlowListYouTubeClass(), ttl=ttl, verbose=False)),
+                         ("stale-while-revalidate", CachedYouTubeClass(
+                             SlowListYouTubeClass(), verbose=False, list_soft_ttl=ttl, list_hard_ttl=60))):
+        proxy.list_videos()  # Warm.
+        latencies = []
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            proxy.list_videos()
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.001)
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1e6
+        p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+        print(f"list_videos {label}: p50 {p50:,.1f}us, p99 {p99:,.1f}us over {len(latencies):,} calls")
+
+
+def benchmark_metrics_overhead(calls: int = 100_000, repeat: int = 5) -> None:
+    # Chi phí thu metrics mỗi lời gọi: cùng proxy/stand-in, metrics=True vs metrics=False (Null Object).
+    # Lấy min qua nhiều lần chạy (như timeit) – overhead cỡ trăm ns dễ bị nhiễu át.
+    best = {}
+    for _ in range(repeat):
+        for enabled in (False, True):
+            proxy = CachedYouTubeClass(InstantYouTubeClass(), max_entries=None, verbose=False, metrics=enabled)
+            proxy.get_video_info("hot")
+            start = time.perf_counter()
+            for _ in range(calls):
+                proxy.get_video_info("hot")  # Hit: 1 counter.
+            hit = (time.perf_counter() - start) / calls
+            start = time.perf_counter()
+            for i in range(calls):
+                proxy.get_video_info(f"cold{i}")  # Miss: counter + lời gọi upstream có đo latency/gauge.
+            miss = (time.perf_counter() - start) / calls
+            previous = best.get(enabled, (hit, miss))
+            best[enabled] = (min(hit, previous[0]), min(miss, previous[1]))
+    for label, index in (("hit", 0), ("miss", 1)):
+        off, on = best[False][index] * 1e9, best[True][index] * 1e9
+        print(f"get_video_info {label}: {off:,.0f}ns without metrics, {on:,.0f}ns with metrics "
+              f"(+{on - off:,.0f}ns per call)")
+    # Riêng call() với upstream rỗng: nhiễu của cache/proxy bị loại, chỉ còn chi phí đo.
+    upstream = {}
+    for _ in range(repeat):
+        for metrics in (_NoMetrics(), ProxyMetrics()):
+            call, fn = metrics.call, dict  # dict(): upstream rẻ nhất có thể.
+            start = time.perf_counter()
+            for _ in range(calls):
+                call("get_video_info", fn)
+            elapsed = (time.perf_counter() - start) / calls
+            upstream[type(metrics)] = min(elapsed, upstream.get(type(metrics), elapsed))
+    off, on = upstream[_NoMetrics] * 1e9, upstream[ProxyMetrics] * 1e9
+    print(f"metrics.call alone: {off:,.0f}ns null object, {on:,.0f}ns ProxyMetrics (+{on - off:,.0f}ns per call)")
+    # Budget vài trăm ns chỉ áp dụng cho hit path (1 counter). Miss path trả thêm 2 lần đọc đồng hồ + gauge
+    # in_flight + append latency – rẻ so với một round trip upstream thật, nhưng không nằm trong budget đó.
+    print("note: the few-hundred-ns budget applies to the hit path; a miss also pays for timing the upstream call")
+
+
 # SỬ DỤNG: Ý NGHĨA CỐT LÕI CHUNG – App config proxy động (dev: real; prod: cached) – runtime flexibility, không sửa client.
 if __name__ == "__main__":
     # Real service (chậm)
@@ -124,3 +1257,63 @@ if __name__ == "__main__":
     manager_proxy = YouTubeManager(proxy_service)
     manager_proxy.react_on_user_input()  # Lần 1: Fetch
     manager_proxy.react_on_user_input()  # Lần 2: Cache – minh họa kiểm soát!
+    print(f"Proxy stats: {proxy_service.stats()}")
+
+    print("\n=== Multi-get (1 batch upstream for the misses) ===")
+    manager_proxy.render_related_videos(["vid123", "vid456", "vid789"])  # vid123 hit, 2 miss → 1 batch.
+    manager_proxy.render_related_videos(["vid123", "vid456", "vid789"])  # Toàn hit.
+
+    print("\n=== Per-key invalidation ===")
+    proxy_service.invalidate("vid123")  # Chỉ vid123 bị refetch; list vẫn cache.
+    manager_proxy.react_on_user_input()
+
+    print("\n=== Stale-while-revalidate list (soft TTL 0.5s, hard TTL 10s) ===")
+    swr_manager = YouTubeManager(CachedYouTubeClass(real_service, list_soft_ttl=0.5, list_hard_ttl=10))
+    swr_manager.render_list_panel()  # Miss: chặn 1s.
+    time.sleep(0.6)
+    start = time.perf_counter()
+    swr_manager.render_list_panel()  # Stale: trả ngay, refresh nền.
+    print(f"Stale render: {time.perf_counter() - start:.3f}s")
+    time.sleep(1.2)  # Chờ refresh nền xong.
+    swr_manager.render_list_panel()  # Fresh hit.
+
+    print("\n=== Persistent warm cache (survives a restart) ===")
+    with tempfile.TemporaryDirectory() as store_dir:
+        store_path = os.path.join(store_dir, "cache.sqlite")
+        store = PersistentCacheStore(store_path)
+        YouTubeManager(CachedYouTubeClass(real_service, store=store)).react_on_user_input()  # Miss: upstream.
+        store.close()  # Shutdown: flush write-behind.
+        print(f"Store: {store.rows_written} rows in {store.batches} batch(es)")
+        store = PersistentCacheStore(store_path)  # "Deploy mới": memory rỗng, store còn.
+        YouTubeManager(CachedYouTubeClass(real_service, store=store)).react_on_user_input()  # Không gọi upstream.
+        store.close()
+
+    print("\n=== Background prefetch (click after list is a cache hit) ===")
+    prefetching_manager = YouTubeManager(CachedYouTubeClass(real_service, verbose=False), prefetch=3)
+    prefetching_manager.render_list_panel()  # Warm info của 3 video đầu trên pool nền.
+    prefetching_manager.wait_for_prefetch()  # Giả lập thời gian user đọc list.
+    start = time.perf_counter()
+    prefetching_manager.render_video_page("Video2")
+    print(f"Click after prefetch: {time.perf_counter() - start:.3f}s")
+    prefetching_manager.close()
+
+    print("\n=== On-disk download cache (restart reuses the index) ===")
+    with tempfile.TemporaryDirectory() as download_dir:
+        disk_proxy = CachedYouTubeClass(real_service, disk_cache=DiskDownloadCache(download_dir, 3 * 1024 * 1024))
+        path = disk_proxy.download_video("vid123")  # Miss: stream vào đĩa.
+        disk_proxy.download_video("vid123")  # Hit.
+        print(f"Downloaded {os.path.getsize(path):,} bytes to {os.path.basename(path)}")
+        restarted = CachedYouTubeClass(real_service, disk_cache=DiskDownloadCache(download_dir, 3 * 1024 * 1024))
+        restarted.download_video("vid123")  # Hit sau restart – không tải lại.
+
+    print("\n=== Thundering herd (200 threads, 1 video) ===")
+    stress_test_single_flight()
+
+    print("\n=== Async Proxy (asyncio frontend) ===")
+    asyncio.run(async_demo())
+
+    if "--bench" in sys.argv[1:]:
+        print()
+        benchmark_cache_memory()
+        benchmark_list_latency()
+        benchmark_metrics_overhead()